@@ -0,0 +1,238 @@
+#!/usr/bin/python3
+
+"""
+Ranks the tests of a regression by the coverage they add, using the
+per-test coverage databases written by regression.py, and writes the
+smallest set of tests found which reaches the same coverage as the whole
+regression as a new regression list.
+"""
+
+import os
+import csv
+import sys
+import json
+import heapq
+import argparse
+import multiprocessing
+
+import pycov
+
+#: Where regression.py writes the coverage database of each test.
+COV_DB_DIR = os.path.join("work","cov-db")
+
+def cov_db_path(hex_file, cov_dir = COV_DB_DIR):
+    """
+    Return the coverage database regression.py writes for a hex file.
+    """
+    return os.path.join(cov_dir, os.path.basename(hex_file)+".cov")
+
+def hit_points(path):
+    """
+    Return the (key, count) of each point in a coverage database which
+    was hit at all.
+    """
+    keys, counts = pycov.parse_cov_file(path)
+    return [(k, c) for k, c in zip(keys, counts) if c > 0]
+
+def load_coverage(rows, cov_dir = COV_DB_DIR, min_count = pycov.ANNOTATE_MIN,
+                  jobs = 1):
+    """
+    Read the coverage of each regression list row.
+
+    A point counts as covered if its hits, summed over all the tests, reach
+    its threshold: min_count, unless its key gives its own threshold, as
+    in pycov.CoverageDB.lines. Only points the whole regression covers are
+    kept, numbered from zero.
+
+    Returns a list of the rows which have a coverage database, a parallel
+    list of dictionaries of point number -> hits for each, the threshold
+    of each point, and a list of the rows with no coverage database.
+    """
+    paths   = [cov_db_path(os.path.expandvars(r["hex"]), cov_dir)
+               for r in rows]
+    found   = [r for r, p in zip(rows, paths) if os.path.isfile(p)]
+    missing = [r for r, p in zip(rows, paths) if not os.path.isfile(p)]
+    paths   = [p for p in paths if os.path.isfile(p)]
+
+    if(jobs > 1):
+        with multiprocessing.Pool(jobs) as pool:
+            per_test = pool.map(hit_points, paths)
+    else:
+        per_test = [hit_points(p) for p in paths]
+
+    totals = {}
+    for hits in per_test:
+        for key, count in hits:
+            totals[key] = totals.get(key, 0) + count
+
+    points     = {}
+    thresholds = []
+    for key in sorted(totals):
+        thresh = int(pycov.parse_key(key).get("s") or min_count)
+        if(totals[key] >= thresh):
+            points[key] = len(thresholds)
+            thresholds.append(thresh)
+
+    tests = [dict((points[k], c) for k, c in hits if k in points)
+             for hits in per_test]
+
+    return found, tests, thresholds, missing
+
+def progress(hits, sums, thresholds):
+    """
+    Return how far a test would take the points it hits towards their
+    thresholds, given the hits of the tests chosen so far in sums.
+    """
+    return sum(min(c, thresholds[p] - sums[p]) for p, c in hits.items()
+               if sums[p] < thresholds[p])
+
+def rank_tests(tests, thresholds, costs = None):
+    """
+    Greedily order tests so each one takes the points as far towards
+    their thresholds as possible, per unit of cost if costs are given.
+    When every threshold is 1 this is the number of new points covered.
+
+    Returns a list of (test index, points added) in rank order, and the
+    number of tests at the start of it which are needed to cover every
+    point. A test may be needed but add no points by itself, if its hits
+    only count once combined with those of later tests. Ties keep the
+    original order of the tests.
+    """
+    sums    = [0] * len(thresholds)
+    tr      = []
+
+    def score(i):
+        gain = progress(tests[i], sums, thresholds)
+        return float(gain) / costs[i] if costs else gain
+
+    # Scores only fall as tests are chosen, so a test whose re-computed
+    # score is still the best is the best test.
+    heap = [(-score(i), i) for i in range(len(tests))]
+    heapq.heapify(heap)
+
+    while(heap):
+        best = heapq.heappop(heap)[1]
+        new = score(best)
+        if(heap and (-new, best) > heap[0]):
+            heapq.heappush(heap, (-new, best))
+            continue
+        if(new <= 0):
+            heapq.heappush(heap, (0, best))
+            break
+
+        gain = 0
+        for p, c in tests[best].items():
+            if(sums[p] < thresholds[p] <= sums[p] + c):
+                gain += 1
+            sums[p] += c
+        tr.append((best, gain))
+
+    chosen = len(tr)
+    return tr + [(i, 0) for i in sorted(i for _, i in heap)], chosen
+
+def prune(selected, tests, thresholds):
+    """
+    Remove tests from the selected list which every point they hit can do
+    without, trying the lowest ranked tests first. Returns the pruned
+    list.
+    """
+    sums = [0] * len(thresholds)
+    for i in selected:
+        for p, c in tests[i].items():
+            sums[p] += c
+
+    selected = list(selected)
+    for i in reversed(list(selected)):
+        if(all(sums[p] - c >= thresholds[p] for p, c in tests[i].items())):
+            selected.remove(i)
+            for p, c in tests[i].items():
+                sums[p] -= c
+    return selected
+
+def write_list(rows, fieldnames, path):
+    """
+    Write regression list rows to a CSV file.
+    """
+    with open(path, "w") as fh:
+        writer = csv.DictWriter(fh, fieldnames = fieldnames,
+                                lineterminator = "\n")
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+def parseargs():
+    """
+    Parses and returns all command line arguments to the program.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("regression_list", type=str,
+        help="CSV file listing the tests of the full regression.")
+    parser.add_argument("-o","--output", type=str, default=None,
+        help="Write the minimal regression list to this CSV file.")
+    parser.add_argument("-r","--ranked", type=str, default=None,
+        help="Write every test, in rank order, to this CSV file.")
+    parser.add_argument("--cov-dir", type=str, default=COV_DB_DIR,
+        help="Directory of per-test coverage databases.")
+    parser.add_argument("--min-count", type=int, default=pycov.ANNOTATE_MIN,
+        help="Hits a point needs, summed over the tests, to count as "+
+             "covered, unless its key gives its own threshold. The same "+
+             "rule as verilator_coverage --annotate.")
+    parser.add_argument("--times", type=str, default=None,
+        help="JSON file of test runtimes written by regression.py. If "+
+             "given, tests are ranked by new points per second.")
+    parser.add_argument("-j","--jobs", type=int, default=1,
+        help="Number of coverage databases to read in parallel.")
+    return parser.parse_args()
+
+def main():
+    """
+    Main entry point for using the script
+    """
+    args = parseargs()
+
+    with open(args.regression_list, "r") as fh:
+        reader     = csv.DictReader(fh, delimiter=",", skipinitialspace=True)
+        fieldnames = [f.strip() for f in reader.fieldnames]
+        rows       = [dict((k.strip(), (v or "").strip())
+                           for k, v in r.items()) for r in reader]
+
+    found, tests, thresholds, missing = load_coverage(rows,
+        cov_dir = args.cov_dir, min_count = args.min_count, jobs = args.jobs)
+    num_points = len(thresholds)
+
+    for row in missing:
+        print("No coverage for %s, leaving it out" % row["hex"])
+
+    costs = None
+    if(args.times):
+        with open(args.times, "r") as fh:
+            times = json.load(fh)
+        known = [t for t in times.values() if t > 0]
+        default = sorted(known)[len(known) // 2] if known else 1.0
+        costs = [max(times.get(os.path.expandvars(r["hex"]), default), 1e-3)
+                 for r in found]
+
+    ranking, chosen = rank_tests(tests, thresholds, costs)
+    selected = prune([i for i, gain in ranking[:chosen]], tests, thresholds)
+
+    print("RANK | NEW POINTS | TOTAL     | TEST")
+    print("-----|------------|-----------|--------------------")
+    total = 0
+    for rank, (i, gain) in enumerate(ranking, 1):
+        total += gain
+        print("%4d | %10d | %8.2f%% | %s%s" % (rank, gain,
+            100.0 * total / num_points if num_points else 0,
+            found[i]["hex"], "" if i in selected else " (redundant)"))
+
+    print("%d of %d tests reach all %d covered points" % (len(selected),
+        len(rows), num_points))
+
+    if(args.output):
+        order = [i for i, gain in ranking if i in selected]
+        write_list([found[i] for i in order], fieldnames, args.output)
+
+    if(args.ranked):
+        write_list([found[i] for i, gain in ranking], fieldnames, args.ranked)
+
+if(__name__=="__main__"):
+    main()
@@ -10,9 +10,39 @@ import re
 import sys
 import yaml
 import argparse
+import multiprocessing
 
 import jinja2
 
+import pycov
+
+#: Where the report templates live.
+TEMPLATE_DIR = os.path.expandvars("$RVM_HOME/verif/coverage")
+
+#: The template environment of this process. See get_environment.
+ENVIRONMENT = None
+
+def get_environment():
+    """
+    Return the template environment of this process, creating it the
+    first time. The environment keeps each template once it has been
+    compiled, so every report rendered by a process shares them.
+    """
+    global ENVIRONMENT
+    if(ENVIRONMENT is None):
+        ld  = jinja2.FileSystemLoader(TEMPLATE_DIR)
+        ENVIRONMENT = jinja2.Environment(loader = ld, auto_reload = False)
+    return ENVIRONMENT
+
+def render_to_file(template_name, path, **context):
+    """
+    Render a template to a file, writing the output as it is generated
+    rather than building the whole document in memory first.
+    """
+    template = get_environment().get_template(template_name)
+    with open(path, "w") as fh:
+        for chunk in template.generate(**context):
+            fh.write(chunk)
 
 class AnnotatedFile(object):
     """
@@ -24,18 +54,17 @@ class AnnotatedFile(object):
         Create a new annotated source file represetnation
         """
 
-        self.lines = []
         self.splitlines = []
         self.filename = os.path.basename(in_file.name)
 
-        self.lines = [l.replace("\t","    ") for l in in_file.readlines()]
-
         matcher = re.compile(" [0-9].*")
 
         # Very crudely parse the annotated source file into a list of
         # tuples. First item of tuple is None, or integer for number of
         # times the line is hit. The second item is the line itself.
-        for line in self.lines:
+        for line in in_file:
+
+            line = line.replace("\t","    ")
 
             check = matcher.match(line)
 
@@ -73,17 +102,54 @@ class AnnotatedFile(object):
         Write out the annotated file with a rendered jinja template to
         the specified file path.
         """
-        ld  = jinja2.FileSystemLoader(
-            os.path.expandvars("$RVM_HOME/verif/coverage"))
-        env = jinja2.Environment(loader = ld)
+        render_to_file("report-template.html", to_file,
+                       lines    = self.splitlines,
+                       filename = self.filename)
+
+
+class CoverageFile(AnnotatedFile):
+    """
+    Describes a single source file annotated with line coverage read
+    straight from coverage databases, rather than from the output of
+    verilator_coverage --annotate.
+    """
 
-        template = env.get_template("report-template.html")
-        
-        result = template.render(lines = self.splitlines,
-                                 filename= self.filename)
-        
-        with open(to_file, "w") as fh:
-            fh.write(result)
+    def __init__(self, source_path, line_cov):
+        """
+        Create a new annotated source file from the source file path and
+        its line coverage, as returned by pycov.CoverageDB.lines.
+        """
+        self.filename = os.path.basename(source_path)
+
+        with open(source_path, "r") as fh:
+            self.splitlines = pycov.annotate(fh, line_cov)
+
+
+def report_annotated(in_path, out_dir):
+    """
+    Parse one annotated file and write its report into out_dir. Returns
+    the file name and coverage score.
+    """
+    print("Parsing    %s" % in_path)
+    with open(in_path, "r") as fh:
+        af = AnnotatedFile(fh)
+    outputfile = os.path.join(out_dir, os.path.basename(in_path)+".html")
+    print("Writing to %s" % outputfile)
+
+    af.writeout(outputfile)
+    return (af.filename, af.getscore())
+
+def report_coverage(source, line_cov, out_dir):
+    """
+    Annotate one source file with its line coverage and write its report
+    into out_dir. Returns the file name and coverage score.
+    """
+    af = CoverageFile(source, line_cov)
+    outputfile = os.path.join(out_dir, af.filename+".html")
+    print("Writing to %s" % outputfile)
+
+    af.writeout(outputfile)
+    return (af.filename, af.getscore())
 
 
 def parseargs():
@@ -95,9 +161,14 @@ def parseargs():
     parser.add_argument("-o","--output", type=str,
         help="output directory path.",
         default="./work/cov-rpt")
-    parser.add_argument("-i","--input", nargs='+',
-        type=argparse.FileType('r'),
+    parser.add_argument("-i","--input", nargs='+', type=str,
         help="List of input files", default=[])
+    parser.add_argument("-c","--coverage", nargs='+', type=str,
+        help="Coverage databases to report on directly, instead of "+
+             "annotated files.", default=[])
+    parser.add_argument("-j","--jobs", type=int, default=1,
+        help="Number of processes used to read coverage databases and "+
+             "render reports.")
 
     args = parser.parse_args()
     return args
@@ -107,16 +178,7 @@ def writeOverview(scores, path):
     """
     Writes an overview of the coverage scores for each file.
     """
-    ld  = jinja2.FileSystemLoader(
-        os.path.expandvars("$RVM_HOME/verif/coverage"))
-    env = jinja2.Environment(loader = ld)
-
-    template = env.get_template("overview-template.html")
-    
-    result = template.render(scores = scores)
-    
-    with open(path, "w") as fh:
-        fh.write(result)
+    render_to_file("overview-template.html", path, scores = scores)
 
 
 def main():
@@ -125,18 +187,28 @@ def main():
     """
     args = parseargs()
 
-    scores = []
+    # Each job is a report function and its arguments.
+    jobs = []
+
+    if(args.coverage):
+        print("Merging    %d coverage databases" % len(args.coverage))
+        db = pycov.merge_files(args.coverage, jobs = args.jobs)
+
+        for source, line_cov in sorted(db.lines().items()):
+            if(not os.path.isfile(source)):
+                print("Skipping   %s (not found)" % source)
+                continue
+            jobs.append((report_coverage, (source, line_cov, args.output)))
 
     for inputfile in args.input:
-        
-        print("Parsing    %s" % inputfile.name)
-        af = AnnotatedFile(inputfile)
-        name = os.path.basename(inputfile.name)+".html"
-        outputfile = os.path.join(args.output,name)
-        print("Writing to %s" % outputfile)
-
-        af.writeout(outputfile)
-        scores.append((af.filename,af.getscore()))
+        jobs.append((report_annotated, (inputfile, args.output)))
+
+    if(args.jobs > 1 and len(jobs) > 1):
+        with multiprocessing.Pool(args.jobs) as pool:
+            results = [pool.apply_async(f, a) for f, a in jobs]
+            scores  = [r.get() for r in results]
+    else:
+        scores = [f(*a) for f, a in jobs]
 
     writeOverview(scores,os.path.join(args.output,"overview.html"))
     
@@ -1,43 +1,135 @@
 #!/usr/bin/python
 
 """
-A script for re-organising verilog hex memory files
+A script for re-organising verilog hex memory files, and for converting
+them into raw little endian binary images which the simulator can map
+straight into memory.
 
 usage: ./hexmem-refactor.py <hex file> <mem word width>
 
-Where <mem word width> is in bytes.
+Where <mem word width> is in bytes. This re-writes the hex file in place.
+Any number of files, or directories of .hex files, can be converted in
+parallel using the options described by --help.
 """
 
 import os
 import sys
+import argparse
+import binascii
+import functools
+import multiprocessing
+
+#: Formats which hex files can be converted into.
+FORMATS = ["hex", "bin"]
+
+def output_path(input_file, out_dir, fmt):
+    """
+    Return where the converted form of input_file is written. Binary
+    images are given a ".bin" extension in place of ".hex".
+    """
+    out_dir = out_dir if out_dir else os.path.dirname(input_file)
+    name    = os.path.basename(input_file)
+    if(fmt == "bin"):
+        name = (name[:-4] if name.endswith(".hex") else name) + ".bin"
+    return os.path.join(out_dir, name)
+
+def convert_line(line, target_width, fmt):
+    """
+    Convert one line of a hex file. For the hex format the line is split
+    into words of target_width characters, lowest addressed word first.
+    For the bin format the bytes of the line are returned in memory order.
+    """
+    if(fmt == "bin"):
+        if(len(line) % 2):
+            line = "0" + line
+        return binascii.unhexlify(line)[::-1]
+
+    endian_buf = []
+    while(len(line) > 0):
+        endian_buf.insert(0, line[0:target_width] + "\n")
+        line = line[target_width:]
+    return "".join(endian_buf)
+
+def convert_file(input_file, target_width = 8, fmt = "hex", out_dir = None):
+    """
+    Convert one hex file, reading and writing it a line at a time. The
+    output is written to a temporary file which then replaces the output
+    path, so a file can be converted in place. Returns the output path.
+    """
+    out_path = output_path(input_file, out_dir, fmt)
+    tmp_path = out_path + ".tmp.%d" % os.getpid()
+
+    with open(input_file, "r") as fh_in:
+        with open(tmp_path, "wb" if fmt == "bin" else "w") as fh_out:
+            for line in fh_in:
+                line = line.strip()
+                if(line):
+                    fh_out.write(convert_line(line, target_width, fmt))
+
+    os.rename(tmp_path, out_path)
+    return out_path
+
+def find_hex_files(paths):
+    """
+    Expand any directories in paths into the .hex files they contain.
+    """
+    tr = []
+    for path in paths:
+        if(os.path.isdir(path)):
+            tr += sorted(os.path.join(path, f) for f in os.listdir(path)
+                         if f.endswith(".hex"))
+        else:
+            tr.append(path)
+    return tr
+
+def parseargs():
+    """
+    Parses and returns all command line arguments to the program.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", type=str, nargs="+",
+        help="Hex files to convert, or directories of them.")
+    parser.add_argument("-w","--width", type=int, default=4,
+        help="Memory word width in bytes, for the hex format.")
+    parser.add_argument("-f","--format", type=str, default="hex",
+        choices=FORMATS,
+        help="Output format. The bin format ignores --width.")
+    parser.add_argument("-o","--output", type=str, default=None,
+        help="Directory to write converted files to. Defaults to the "+
+             "directory of each input file.")
+    parser.add_argument("-j","--jobs", type=int, default=1,
+        help="Number of files to convert in parallel.")
+    return parser.parse_args()
 
 def main():
     """
     Main function for the program.
     """
-    input_file      = sys.argv[1]
-    target_width    = int(sys.argv[2]) * 2
+    if(len(sys.argv) == 3 and sys.argv[2].isdigit()):
+        print("Processing: %s" % sys.argv[1])
+        convert_file(sys.argv[1], int(sys.argv[2]) * 2)
+        return
 
-    to_write = ""
-        
-    print("Processing: %s" % input_file)
+    args  = parseargs()
+    files = find_hex_files(args.inputs)
 
-    with open(input_file,"r") as fh:
-        for line in fh.readlines():
-            slices = line[:-1]
-            
-            endian_buf = []
+    if(args.output and not os.path.isdir(args.output)):
+        os.makedirs(args.output)
 
-            while(len(slices) > 0):
-                k = slices[0:target_width]
-                endian_buf.insert(0,k+"\n")
-                slices = slices[target_width:]
+    convert = functools.partial(convert_file, target_width = args.width * 2,
+                                fmt = args.format, out_dir = args.output)
 
-            for b in endian_buf:
-                to_write += b
+    if(args.jobs > 1 and len(files) > 1):
+        pool    = multiprocessing.Pool(args.jobs)
+        outputs = pool.map(convert, files)
+        pool.close()
+        pool.join()
+    else:
+        outputs = [convert(f) for f in files]
 
-    with open(input_file,"w") as fh:
-        fh.write(to_write)
+    for input_file, out_path in zip(files, outputs):
+        print("%s -> %s" % (input_file, out_path))
 
 if(__name__=="__main__"):
     main()
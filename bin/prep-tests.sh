@@ -51,5 +51,15 @@ source_riscv_tests()
         $ELF2HEX 4 8192 $ELF/$ELF_FILE > $HEX/$ELF_FILE.hex
     done
 
+    # Index the symbols of the disassembly files, so regression.py does
+    # not need to parse them all on its first run.
+    $RVM_HOME/bin/pysyms.py -j `nproc` --index $RVM_HOME/work/dis-index.json \
+        $DIS > /dev/null
+
+    # Raw binary images of the hex files, which the simulator maps
+    # straight into memory. They are written next to the hex files, where
+    # regression.py and "make run-vl" look for them.
+    $RVM_HOME/bin/hexmem-refactor.py -f bin -j `nproc` $HEX > /dev/null
+
     echo " [DONE]"
 }
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+
+"""
+Reads, merges and writes Verilator coverage databases (.cov files)
+without calling verilator_coverage, and works out per source line hit
+counts in the same way as "verilator_coverage --annotate".
+"""
+
+import os
+import sys
+import argparse
+import operator
+import multiprocessing
+
+from array import array
+
+#: First line of every coverage database written by Verilator.
+COV_HEADER = "# SystemC::Coverage-3"
+
+#: Separators between, and within, the key/value pairs of a point key.
+KEY_SEP     = "\x01"
+VALUE_SEP   = "\x02"
+
+#: A point is counted as covered if it is hit at least this many times,
+#: unless its key gives its own threshold. Matches verilator_coverage.
+ANNOTATE_MIN = 10
+
+def parse_cov_file(path):
+    """
+    Parse one coverage database, returning a list of point keys and an
+    array of their counts, in file order.
+    """
+    with open(path, "r", encoding="latin-1") as fh:
+        points = [line[3:].rpartition("' ") for line in fh
+                  if line.startswith("C '")]
+
+    keys   = [p[0] for p in points]
+    counts = array("Q", map(int, [p[2] for p in points]))
+
+    return keys, counts
+
+def parse_key(key):
+    """
+    Split a point key into a dictionary of its fields.
+    """
+    fields = {}
+    for field in key.split(KEY_SEP):
+        name, _, value = field.partition(VALUE_SEP)
+        if(name):
+            fields[name] = value
+    return fields
+
+
+class CoverageDB(object):
+    """
+    The counters of a set of coverage points, held as a list of point
+    keys and a parallel array of counts.
+    """
+
+    def __init__(self):
+        """
+        Create an empty coverage database.
+        """
+        self.keys   = []            # Point keys, in order.
+        self.index  = {}            # Point key -> position in keys.
+        self.counts = array("Q")    # Count of each point.
+
+    @staticmethod
+    def read(path):
+        """
+        Read and return the coverage database at path.
+        """
+        tr = CoverageDB()
+        tr.add(*parse_cov_file(path))
+        return tr
+
+    def add(self, keys, counts):
+        """
+        Add the counts of the points with the given keys.
+
+        Databases written by the same simulator list the same points in
+        the same order. When that is the case the counts are summed as
+        whole arrays, rather than point by point.
+        """
+        if(keys == self.keys):
+            self.counts = array("Q", map(operator.add, self.counts, counts))
+            return
+
+        if(not self.keys):
+            index = dict((k, i) for i, k in enumerate(keys))
+            if(len(index) == len(keys)):
+                self.keys   = list(keys)
+                self.index  = index
+                self.counts = array("Q", counts)
+                return
+
+        for key, count in zip(keys, counts):
+            i = self.index.get(key)
+            if(i is None):
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+                self.counts.append(count)
+            else:
+                self.counts[i] += count
+
+    def merge(self, other):
+        """
+        Add the counts of another CoverageDB to this one.
+        """
+        self.add(other.keys, other.counts)
+
+    def write(self, path):
+        """
+        Write the database out in the format Verilator uses.
+        """
+        with open(path, "w", encoding="latin-1") as fh:
+            fh.write(COV_HEADER + "\n")
+            for key, count in zip(self.keys, self.counts):
+                fh.write("C '%s' %d\n" % (key, count))
+
+    def lines(self, annotate_min = ANNOTATE_MIN):
+        """
+        Return the coverage of each source line, as a dictionary of
+        filename -> line number -> column -> [count, ok], where count
+        is the total count of the points at that column and ok is True
+        if any of them reached its threshold.
+        """
+        tr = {}
+        for key, count in zip(self.keys, self.counts):
+            fields   = parse_key(key)
+            filename = fields.get("f", "")
+            lineno   = int(fields.get("l", 0) or 0)
+            if(not filename or not lineno):
+                continue
+            column   = int(fields.get("n", 0) or 0)
+            thresh   = int(fields.get("s") or annotate_min)
+
+            entry = tr.setdefault(filename, {}) \
+                      .setdefault(lineno, {}) \
+                      .setdefault(column, [0, False])
+            entry[0] += count
+            entry[1]  = entry[1] or count >= thresh
+        return tr
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def annotate(source_lines, line_cov):
+    """
+    Combine the lines of a source file with the coverage of its lines,
+    as returned for one file by CoverageDB.lines. Returns a list of
+    (count, line) tuples as verilator_coverage --annotate would show them:
+    count is "" for lines without coverage points, 0 for points below
+    their threshold, or else the number of hits. A line with points at
+    several columns is followed by one extra entry per extra column.
+    """
+    tr = []
+    for lineno, line in enumerate(source_lines, 1):
+        line    = line.rstrip("\n").replace("\t","    ")
+        columns = line_cov.get(lineno)
+        if(not columns):
+            tr.append(("", line))
+            continue
+        for column in sorted(columns):
+            count, ok = columns[column]
+            tr.append((count if ok else 0, line))
+            indent = line[:len(line) - len(line.lstrip())]
+            line   = indent + "verilator_coverage: (next point on previous line)"
+    return tr
+
+def merge_chunk(paths):
+    """
+    Read and merge a list of coverage databases. Used by merge_files to
+    merge files in worker processes.
+    """
+    tr = CoverageDB()
+    for path in paths:
+        tr.add(*parse_cov_file(path))
+    return tr
+
+def merge_files(paths, jobs = 1):
+    """
+    Read and merge the coverage databases at paths, splitting the work
+    between up to "jobs" processes. Returns the merged CoverageDB.
+    """
+    if(jobs <= 1 or len(paths) < 2):
+        return merge_chunk(paths)
+
+    chunks = [paths[i::jobs] for i in range(jobs) if paths[i::jobs]]
+    with multiprocessing.Pool(len(chunks)) as pool:
+        parts = pool.map(merge_chunk, chunks)
+
+    tr = parts[0]
+    for part in parts[1:]:
+        tr.merge(part)
+    return tr
+
+
+def parseargs():
+    """
+    Parses and returns all command line arguments to the program.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-w","--write", type=str, default=None,
+        help="Write the merged coverage database to this file.")
+    parser.add_argument("-j","--jobs", type=int, default=1,
+        help="Number of processes used to read the input files.")
+    parser.add_argument("inputs", type=str, nargs="+",
+        help="Coverage databases to read.")
+    return parser.parse_args()
+
+def main():
+    """
+    Merge coverage databases. Takes the same arguments as
+    "verilator_coverage --write", so can be used as $RVM_VERILATOR_COV
+    for merging.
+    """
+    args = parseargs()
+    db   = merge_files(args.inputs, jobs = args.jobs)
+
+    if(args.write):
+        db.write(args.write)
+    else:
+        for filename, lines in sorted(db.lines().items()):
+            points  = sum(len(cols) for cols in lines.values())
+            covered = sum(ok for cols in lines.values()
+                          for count, ok in cols.values())
+            print("%6.2f%% %s" % (100.0 * covered / points, filename))
+
+if(__name__=="__main__"):
+    main()
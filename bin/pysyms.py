@@ -0,0 +1,379 @@
+#!/usr/bin/python3
+
+"""
+An index of the symbols and instructions in the objdump disassembly (.dis)
+files of the test programs, so that pass/fail/halt addresses and PC to
+symbol or instruction lookups do not need to re-scan the disassembly.
+
+The symbols of every file are kept in a single, small, JSON index file,
+which is all most users need. The instructions of each file are kept in a
+table file of their own, which is only read when an instruction is looked
+up. An entry is rebuilt only when the modification time or size of its
+disassembly file changes.
+"""
+
+import os
+import sys
+import json
+import bisect
+import hashlib
+import argparse
+import multiprocessing
+
+#: Where the index of all test disassembly files is kept by default.
+INDEX_FILE = os.path.join("work","dis-index.json")
+
+#: Bumped whenever the layout of the index file changes.
+INDEX_VERSION = 2
+
+class DisFile(object):
+    """
+    The symbols and instructions of one disassembly file, as written by
+    "objdump -D".
+    """
+
+    def __init__(self, path):
+        """
+        Create an empty description of the disassembly file at path. Use
+        DisFile.parse or DisFile.fromDict to fill it in.
+        """
+        self.path           = path
+        self.mtime          = None
+        self.size           = None
+        self.symbols        = {}    # Symbol name -> address.
+        self.sym_addrs      = []    # Sorted symbol addresses.
+        self.sym_names      = []    # Symbol names, in sym_addrs order.
+        self.instructions   = None  # Address -> (encoding, text).
+        self.table_file     = None  # Where the instructions are kept.
+
+    @staticmethod
+    def parse(path):
+        """
+        Parse the disassembly file at path and return a new DisFile.
+        """
+        tr              = DisFile(path)
+        st              = os.stat(path)
+        tr.mtime        = st.st_mtime
+        tr.size         = st.st_size
+        tr.instructions = {}
+
+        with open(path,"r") as fh:
+            for line in fh:
+                if("\t" in line):
+                    tr.__parse_instruction__(line)
+                elif(line.endswith(">:\n")):
+                    addr, _, name = line[:-3].partition(" <")
+                    try:
+                        tr.symbols[name] = int(addr, 16)
+                    except ValueError:
+                        pass
+
+        tr.__sort_symbols__()
+        return tr
+
+    def __parse_instruction__(self, line):
+        """
+        Add a line of the form "<addr>:<tab><encoding><tab><text>" to the
+        instruction table. Any other line is ignored.
+        """
+        fields = line.strip().split("\t")
+        if(len(fields) < 3 or not fields[0].endswith(":")):
+            return
+        try:
+            addr = int(fields[0][:-1], 16)
+        except ValueError:
+            return
+        self.instructions[addr] = (fields[1].strip(),
+                                   " ".join(fields[2:]).strip())
+
+    def __sort_symbols__(self):
+        """
+        Build the sorted symbol tables used by symbol_at.
+        """
+        by_addr         = sorted((a, n) for n, a in self.symbols.items())
+        self.sym_addrs  = [a for a, n in by_addr]
+        self.sym_names  = [n for a, n in by_addr]
+
+    def is_current(self):
+        """
+        Return True if the disassembly file is unchanged since it was
+        parsed.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return st.st_mtime == self.mtime and st.st_size == self.size
+
+    def address_of(self, name):
+        """
+        Return the address of the named symbol, or None if there is no
+        such symbol.
+        """
+        return self.symbols.get(name)
+
+    def symbol_at(self, pc):
+        """
+        Return the name of the symbol containing address pc and the offset
+        of pc from it, or None if pc is before the first symbol.
+        """
+        i = bisect.bisect_right(self.sym_addrs, pc)
+        if(i == 0):
+            return None
+        return self.sym_names[i-1], pc - self.sym_addrs[i-1]
+
+    def instruction_at(self, pc):
+        """
+        Return the (encoding, text) of the instruction at address pc, or
+        None if there is none.
+        """
+        return self.load_instructions().get(pc)
+
+    def load_instructions(self):
+        """
+        Return the instruction table, reading it from the table file the
+        first time, or parsing the disassembly file again if the table
+        file is missing or out of date.
+        """
+        if(self.instructions is not None):
+            return self.instructions
+
+        if(self.table_file and os.path.isfile(self.table_file)):
+            with open(self.table_file,"r") as fh:
+                try:
+                    d = json.load(fh)
+                except ValueError:
+                    d = {}
+            if(d.get("mtime") == self.mtime and d.get("size") == self.size):
+                self.instructions = dict(zip(d["addrs"],
+                                             zip(d["encs"], d["texts"])))
+                return self.instructions
+
+        self.instructions = DisFile.parse(self.path).instructions
+        return self.instructions
+
+    def tableDict(self):
+        """
+        Return the instruction table as a dictionary, suitable for
+        serialising to the table file.
+        """
+        addrs = sorted(self.load_instructions())
+        return {"mtime"         : self.mtime,
+                "size"          : self.size,
+                "addrs"         : addrs,
+                "encs"          : [self.instructions[a][0] for a in addrs],
+                "texts"         : [self.instructions[a][1] for a in addrs]}
+
+    def toDict(self):
+        """
+        Return the symbols of the file as a dictionary, suitable for
+        serialising to the index file.
+        """
+        return {"path"          : self.path,
+                "mtime"         : self.mtime,
+                "size"          : self.size,
+                "symbols"       : self.symbols}
+
+    @staticmethod
+    def fromDict(d, table_file = None):
+        """
+        Re-build a DisFile from the output of toDict. Its instructions are
+        read from table_file when they are first needed.
+        """
+        tr              = DisFile(d["path"])
+        tr.mtime        = d["mtime"]
+        tr.size         = d["size"]
+        tr.symbols      = d["symbols"]
+        tr.table_file   = table_file
+        tr.__sort_symbols__()
+        return tr
+
+
+def parse_dis_file(path):
+    """
+    Module level wrapper of DisFile.parse, so it can be sent to worker
+    processes.
+    """
+    return DisFile.parse(path)
+
+
+class SymbolIndex(object):
+    """
+    An index of many disassembly files, loaded from and saved to a single
+    index file. Entries for files which have changed since they were
+    indexed are rebuilt when they are looked up.
+    """
+
+    def __init__(self, index_file = INDEX_FILE):
+        """
+        Load the index from index_file, if it exists. Instruction tables
+        are kept in a directory named after the index file, without its
+        extension.
+        """
+        self.index_file = index_file
+        self.table_dir  = os.path.splitext(index_file)[0] if index_file \
+                          else None
+        self.files      = {}
+        self.dirty      = False
+        self.new_tables = set()     # Paths whose table file is stale.
+
+        if(index_file and os.path.isfile(index_file)):
+            with open(index_file,"r") as fh:
+                try:
+                    d = json.load(fh)
+                except ValueError:
+                    d = {}
+            if(d.get("version") == INDEX_VERSION):
+                for f in d["files"]:
+                    self.files[f["path"]] = DisFile.fromDict(f,
+                        table_file = self.table_path(f["path"]))
+
+    def table_path(self, path):
+        """
+        Return where the instruction table of a disassembly file is kept,
+        or None if the index is not saved.
+        """
+        if(not self.table_dir):
+            return None
+        name = hashlib.sha1(path.encode("utf-8")).hexdigest() + ".json"
+        return os.path.join(self.table_dir, name)
+
+    def __add_entry__(self, entry):
+        """
+        Add a newly parsed DisFile to the index.
+        """
+        entry.table_file        = self.table_path(entry.path)
+        self.files[entry.path]  = entry
+        self.new_tables.add(entry.path)
+        self.dirty              = True
+
+    def get(self, path):
+        """
+        Return the DisFile for the disassembly file at path, parsing it if
+        it is not indexed or has changed. Returns None if there is no such
+        file.
+        """
+        entry = self.files.get(path)
+        if(entry is not None and entry.is_current()):
+            return entry
+        if(not os.path.isfile(path)):
+            return None
+        entry = DisFile.parse(path)
+        self.__add_entry__(entry)
+        return entry
+
+    def build(self, paths, jobs = 1):
+        """
+        Make sure every file in paths is indexed and current, parsing up
+        to "jobs" of them at once.
+        """
+        stale = [p for p in paths if os.path.isfile(p) and
+                 (p not in self.files or not self.files[p].is_current())]
+        if(not stale):
+            return
+
+        if(jobs > 1 and len(stale) > 1):
+            pool = multiprocessing.Pool(jobs)
+            parsed = pool.map(parse_dis_file, stale)
+            pool.close()
+            pool.join()
+        else:
+            parsed = [DisFile.parse(p) for p in stale]
+
+        for entry in parsed:
+            self.__add_entry__(entry)
+
+    def address_of(self, path, name):
+        """
+        Return the address of the named symbol in a disassembly file, or
+        None if the file or symbol does not exist.
+        """
+        entry = self.get(path)
+        return entry.address_of(name) if entry else None
+
+    def save(self):
+        """
+        Write the index back to its index file, and the instruction table
+        of each newly parsed file to its table file, if anything changed.
+        """
+        if(not self.dirty or not self.index_file):
+            return
+
+        if(not os.path.isdir(self.table_dir)):
+            os.makedirs(self.table_dir)
+
+        for path in sorted(self.new_tables):
+            entry = self.files[path]
+            write_json(entry.table_file, entry.tableDict())
+        self.new_tables = set()
+
+        write_json(self.index_file, {"version": INDEX_VERSION,
+                                     "files"  : [self.files[p].toDict()
+                                                 for p in sorted(self.files)]})
+        self.dirty = False
+
+
+def write_json(path, d):
+    """
+    Write d to a JSON file, under a temporary name which is then renamed,
+    so that readers never see a partly written file.
+    """
+    tmp_path = path + ".tmp.%d" % os.getpid()
+    with open(tmp_path,"w") as fh:
+        json.dump(d, fh)
+    os.rename(tmp_path, path)
+
+
+def parseargs():
+    """
+    Parses and returns all command line arguments to the program.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--index", type=str, default=INDEX_FILE,
+        help="Index file to use.")
+    parser.add_argument("-j","--jobs", type=int, default=1,
+        help="Number of disassembly files to parse in parallel.")
+    parser.add_argument("dis_files", type=str, nargs="+",
+        help="Disassembly files to index, or directories of them.")
+    parser.add_argument("--symbol", type=str, default=None,
+        help="Print the address of this symbol in each file.")
+    parser.add_argument("--pc", type=str, default=None,
+        help="Print the symbol and instruction at this hex address in "+
+             "each file.")
+    return parser.parse_args()
+
+def main():
+    """
+    Build or update the index, then answer any queries.
+    """
+    args  = parseargs()
+    paths = []
+    for path in args.dis_files:
+        if(os.path.isdir(path)):
+            paths += sorted(os.path.join(path, f) for f in os.listdir(path)
+                            if f.endswith(".dis"))
+        else:
+            paths.append(path)
+
+    index = SymbolIndex(args.index)
+    index.build(paths, jobs = args.jobs)
+    index.save()
+
+    for path in paths:
+        entry = index.get(path)
+        if(entry is None):
+            continue
+        if(args.symbol):
+            addr = entry.address_of(args.symbol)
+            print("%s: %s" % (path, "%08x" % addr if addr is not None
+                                    else "not found"))
+        if(args.pc):
+            pc   = int(args.pc, 16)
+            sym  = entry.symbol_at(pc)
+            ins  = entry.instruction_at(pc)
+            print("%s: %08x <%s+0x%x> %s" % (path, pc,
+                sym[0] if sym else "?", sym[1] if sym else 0,
+                "\t".join(ins) if ins else "no instruction"))
+
+if(__name__=="__main__"):
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+
+"""
+Reads the instruction retire traces written by the Verilator simulation
+when it is given +RETIRE_TRACE=<file>, or by regression.py --retire-trace.
+
+A trace file is an 8 byte magic number, a 32-bit format version and the
+32-bit size of each record, followed by fixed size records of:
+
+    cycle (64 bits), pc, instr, rd_wdata, rd_info (32 bits each)
+
+where rd_info holds the rd address in bits 4:0 and the rd write enable in
+bit 8. Everything is little endian.
+"""
+
+import os
+import mmap
+import struct
+import argparse
+import collections
+
+#: First bytes of every retire trace file.
+TRACE_MAGIC     = b"RVMTRACE"
+
+#: Version of the trace file format this reader understands.
+TRACE_VERSION   = 1
+
+#: Header layout: magic, version, record size.
+HEADER_FORMAT   = "<8sII"
+HEADER_SIZE     = struct.calcsize(HEADER_FORMAT)
+
+#: Record layout.
+RECORD_FORMAT   = "<QIIII"
+RECORD_SIZE     = struct.calcsize(RECORD_FORMAT)
+
+#: Number of 32-bit words in each record, and the position of each field.
+RECORD_WORDS    = RECORD_SIZE // 4
+PC_WORD         = 2
+INSTR_WORD      = 3
+WDATA_WORD      = 4
+INFO_WORD       = 5
+
+#: A single retired instruction.
+Retirement = collections.namedtuple("Retirement",
+    ["cycle", "pc", "instr", "rd_wen", "rd_addr", "rd_wdata"])
+
+class RetireTrace(object):
+    """
+    A retire trace file. The file is memory mapped rather than read, and
+    each field is available as an array-like view over every record, so
+    nothing is copied until it is used.
+    """
+
+    def __init__(self, trace_file_path):
+        """
+        Open a retire trace file and check its header.
+        """
+        self.file_path  = trace_file_path
+
+        with open(self.file_path, "rb") as fh:
+            size = os.fstat(fh.fileno()).st_size
+            if(size < HEADER_SIZE):
+                raise ValueError("%s is not a retire trace" % trace_file_path)
+            self.__map__ = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic, version, record_size = struct.unpack_from(HEADER_FORMAT,
+                                                         self.__map__)
+        if(magic != TRACE_MAGIC or version != TRACE_VERSION or
+           record_size != RECORD_SIZE):
+            self.__map__.close()
+            raise ValueError("%s is not a version %d retire trace" % (
+                trace_file_path, TRACE_VERSION))
+
+        # A simulation which did not finish may leave a partial record.
+        count = (size - HEADER_SIZE) // RECORD_SIZE
+        view  = memoryview(self.__map__)
+        self.__view__   = view[HEADER_SIZE:HEADER_SIZE + count * RECORD_SIZE]
+        self.__words__  = self.__view__.cast("I")
+        self.__count__  = count
+
+        self.cycles     = self.__view__.cast("Q")[0::RECORD_SIZE // 8]
+        self.pcs        = self.__words__[PC_WORD::RECORD_WORDS]
+        self.instrs     = self.__words__[INSTR_WORD::RECORD_WORDS]
+        self.rd_wdatas  = self.__words__[WDATA_WORD::RECORD_WORDS]
+        self.rd_infos   = self.__words__[INFO_WORD::RECORD_WORDS]
+
+        view.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Release the views of the file and unmap it.
+        """
+        for name in ["cycles", "pcs", "instrs", "rd_wdatas", "rd_infos"]:
+            getattr(self, name).release()
+        self.__words__.release()
+        self.__view__.release()
+        self.__map__.close()
+
+    def __len__(self):
+        return self.__count__
+
+    def __getitem__(self, i):
+        """
+        Return the i'th retired instruction as a Retirement.
+        """
+        if(i < 0):
+            i += self.__count__
+        if(i < 0 or i >= self.__count__):
+            raise IndexError("retire trace index out of range")
+        cycle, pc, instr, wdata, info = struct.unpack_from(RECORD_FORMAT,
+            self.__view__, i * RECORD_SIZE)
+        return Retirement(cycle, pc, instr, bool(info & 0x100),
+                          info & 0x1F, wdata)
+
+    def __iter__(self):
+        """
+        Iterate over every retired instruction, in order.
+        """
+        for cycle, pc, instr, wdata, info in struct.iter_unpack(
+                RECORD_FORMAT, self.__view__):
+            yield Retirement(cycle, pc, instr, bool(info & 0x100),
+                             info & 0x1F, wdata)
+
+    def pc_counts(self):
+        """
+        Return a Counter of how many times each PC retired.
+        """
+        return collections.Counter(self.pcs)
+
+
+def format_retirement(r, dis = None):
+    """
+    Return a retired instruction as a line of text, with its symbol and
+    disassembly if a pysyms.DisFile is given.
+    """
+    tr = "%10d %08x %08x" % (r.cycle, r.pc, r.instr)
+    tr += " x%-2d = %08x" % (r.rd_addr, r.rd_wdata) if r.rd_wen else " " * 15
+    if(dis is not None):
+        sym = dis.symbol_at(r.pc)
+        ins = dis.instruction_at(r.pc)
+        tr += " <%s+0x%x>" % sym if sym else " <?>"
+        tr += " " + ins[1] if ins else ""
+    return tr.rstrip()
+
+def parseargs():
+    """
+    Parses and returns all command line arguments to the program.
+    """
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace_file", type=str,
+        help="Retire trace to read.")
+    parser.add_argument("--dis", type=str, default=None,
+        help="Disassembly file of the test, used to show the symbol and "+
+             "instruction of each PC.")
+    parser.add_argument("-n","--count", type=int, default=None,
+        help="Only print the last this many instructions.")
+    parser.add_argument("--hot", type=int, default=None,
+        help="Print the this many most often retired PCs instead.")
+    return parser.parse_args()
+
+def main():
+    """
+    Print a retire trace.
+    """
+    args = parseargs()
+    dis  = None
+    if(args.dis):
+        import pysyms
+        dis = pysyms.DisFile.parse(args.dis)
+
+    with RetireTrace(args.trace_file) as trace:
+        if(args.hot):
+            for pc, count in trace.pc_counts().most_common(args.hot):
+                ins = dis.instruction_at(pc) if dis else None
+                print(("%10d %08x %s" % (count, pc,
+                       ins[1] if ins else "")).rstrip())
+        else:
+            start = 0
+            if(args.count is not None):
+                start = max(0, len(trace) - args.count)
+            for i in range(start, len(trace)):
+                print(format_retirement(trace[i], dis))
+
+        print("%d instructions retired" % len(trace))
+
+if(__name__=="__main__"):
+    main()
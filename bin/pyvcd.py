@@ -2,8 +2,17 @@
 
 import os
 import sys
+import json
+import mmap
+import struct
+import multiprocessing
+import bisect
+import fnmatch
+import operator
 import bitstring
 
+from array import array
+
 class VCDScope(object):
     """
     Describes the scope of a signal in a VCD file.
@@ -49,6 +58,223 @@ class VCDScope(object):
         """
         self.vars.append(name)
 
+    def toDict(self):
+        """
+        Return the scope and all of its children as nested dictionaries,
+        suitable for serialising.
+        """
+        return {"name"      : self.name,
+                "vars"      : self.vars,
+                "children"  : [c.toDict() for c in self.children]}
+
+    @staticmethod
+    def fromDict(d, parentScope = None):
+        """
+        Re-build a scope tree from the output of toDict.
+        """
+        tr = VCDScope(d["name"], parentScope = parentScope)
+        tr.vars = list(d["vars"])
+        for c in d["children"]:
+            tr.addChild(VCDScope.fromDict(c, parentScope = tr))
+        return tr
+
+
+#: Translation tables used to split a 4-state VCD value string into its
+#: 2-state value bits and a mask of the bits which are X or Z. Under the
+#: mask, a value bit of 0 means X and a value bit of 1 means Z.
+XZ_VALUE_TABLE  = str.maketrans("01xXzZ", "010011")
+XZ_MASK_TABLE   = str.maketrans("01xXzZ", "001111")
+
+#: Largest number of bytes of a VCD file parsed in one go by a worker
+#: process when parsing in parallel.
+PARALLEL_CHUNK_SIZE = 64 * 1024 * 1024
+
+#: Appended to the path of a VCD file to get the path of its cache file.
+CACHE_SUFFIX    = ".cache"
+
+#: Identifies (and versions) the format of VCD cache files.
+CACHE_MAGIC     = b"PYVCD\x00\x00\x01"
+
+class VCDSignal(object):
+    """
+    Columnar storage for every value change of a single signal. Change
+    times and values are held in parallel packed arrays, with the X/Z
+    bits of any 4-state values kept in a separate sparse mask.
+    """
+
+    def __init__(self, width, real = False):
+        """
+        Instance a new, empty signal of the given width in bits.
+        """
+        self.width      = width
+        self.real       = real
+        self.times      = array("Q")
+
+        if(real):
+            self.values = array("d")
+        elif(width <= 64):
+            self.values = array("Q")
+        else:
+            self.values = []    # Too wide for a machine word.
+
+        self.xz         = {}    # Change index -> mask of X/Z bits.
+
+        self.__intervals__ = None
+        self.__when__      = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def decode(self, value):
+        """
+        Split a VCD value string into a (value, xz mask) tuple, as stored
+        in the value columns. Integers are passed through unchanged.
+        """
+        if(not isinstance(value, str)):
+            return (value, 0)
+        elif(self.real):
+            return (float(value.lstrip("rR")), 0)
+
+        try:
+            return (int(value, 2), 0)
+        except ValueError:
+            if(len(value) < self.width and value[0] in "xXzZ"):
+                value = value[0] * (self.width - len(value)) + value
+            return (int(value.translate(XZ_VALUE_TABLE), 2),
+                    int(value.translate(XZ_MASK_TABLE ), 2))
+
+    def append(self, time, value):
+        """
+        Add a new value change for the signal. The value is a VCD value
+        string with any leading "b" already removed. A second change at
+        the same time as the last one replaces it.
+        """
+        xz = 0
+
+        if(self.real):
+            v = float(value[1:])
+        else:
+            try:
+                v = int(value, 2)
+            except ValueError:
+                v, xz = self.decode(value)
+
+        self.__intervals__ = None
+        self.__when__      = {}
+
+        i = len(self.times)
+        if(i > 0 and self.times[-1] == time):
+            i -= 1
+            self.values[i] = v
+            self.xz.pop(i, None)
+        else:
+            self.times.append(time)
+            self.values.append(v)
+
+        if(xz):
+            self.xz[i] = xz
+
+    def extend(self, other):
+        """
+        Append all of the changes of another signal, which must all come
+        after the changes already held by this one.
+        """
+        base = len(self.times)
+        self.times.extend(other.times)
+        self.values.extend(other.values)
+        for i, mask in other.xz.items():
+            self.xz[base + i] = mask
+
+        self.__intervals__ = None
+        self.__when__      = {}
+
+    def render(self, i):
+        """
+        Return the i'th value change as a binary string, zero padded to
+        the width of the signal, with any X/Z bits filled in.
+        """
+        if(self.real):
+            return "r" + repr(self.values[i])
+
+        tr = format(self.values[i], "0%db" % self.width)
+
+        if(i in self.xz):
+            mask = format(self.xz[i], "0%db" % self.width)
+            tr = "".join([(("z" if b == "1" else "x") if m == "1" else b)
+                          for b, m in zip(tr, mask)])
+
+        return tr
+
+    def value(self, i):
+        """
+        Return the i'th value change. This is an integer (or float, for
+        real signals), unless some of its bits are X or Z, in which case
+        the rendered binary string is returned instead.
+        """
+        if(i in self.xz):
+            return self.render(i)
+        return self.values[i]
+
+    def index_at(self, time):
+        """
+        Return the index of the change in effect at the given time, or
+        -1 if the signal has not yet been assigned by then.
+        """
+        return bisect.bisect_right(self.times, time) - 1
+
+    def value_at(self, time):
+        """
+        Return the value of the signal at the given time, or None if the
+        signal has not yet been assigned by then.
+        """
+        i = self.index_at(time)
+        if(i < 0):
+            return None
+        return self.value(i)
+
+    def changes_between(self, start, end):
+        """
+        Return a list of (time, value) tuples for every change made in the
+        half open time interval [start, end).
+        """
+        lo = bisect.bisect_left(self.times, start)
+        hi = bisect.bisect_left(self.times, end)
+        return [(self.times[i], self.value(i)) for i in range(lo, hi)]
+
+    def intervals(self):
+        """
+        Return a list of (start, end, value) tuples, one per change, where
+        each value holds from start until the time of the next change.
+        The final change has an end of None. The list is cached until the
+        signal is next changed.
+        """
+        if(self.__intervals__ is None):
+            n  = len(self.times)
+            tr = []
+            for i in range(n):
+                end = self.times[i+1] if i+1 < n else None
+                tr.append((self.times[i], end, self.value(i)))
+            self.__intervals__ = tr
+        return self.__intervals__
+
+    def intervals_when(self, value):
+        """
+        Return a cached list of (start, end) tuples covering every time
+        the signal holds the given value, which may be an integer or a
+        VCD value string. The final, open ended change is not included.
+        """
+        key = self.decode(value)
+
+        if(key not in self.__when__):
+            v, xz = key
+            tr = []
+            for i in range(len(self.times) - 1):
+                if(self.values[i] == v and self.xz.get(i, 0) == xz):
+                    tr.append((self.times[i], self.times[i+1]))
+            self.__when__[key] = tr
+
+        return self.__when__[key]
+
 
 class VCDValues(object):
     """
@@ -60,55 +286,431 @@ class VCDValues(object):
         """
         Instance a new VCDValues class.
         """
-        self.__time__       = 0
-        self.times          = []
+        self.times          = array("Q")
 
-        self.by_alias       = {}
-        self.by_time        = {}
+        self.signals        = {}
         self.alias_widths   = {}
 
-    def addAlias(self, alias,width):
+    def addAlias(self, alias, width, real = False):
         """
         Add a new alias to the values database
         """
-        self.by_alias[alias]    = {}
+        self.signals[alias]     = VCDSignal(width, real = real)
         self.alias_widths[alias]= width
 
     def addTime(self, time):
         """
-        Add a new time value to the values database.
+        Add a new time value to the values database. Times are expected
+        to arrive in increasing order, as they do in a VCD file.
         """
-        self.by_time[time] = {}
-        if(not time in self.times):
+        if(not self.times or time > self.times[-1]):
             self.times.append(time)
+        else:
+            i = bisect.bisect_left(self.times, time)
+            if(self.times[i] != time):
+                self.times.insert(i, time)
     
     def addValue(self, time, alias, value):
         """
         Add a new value for a signal at a given time and scope.
         """
-        v = value
-        if(value.startswith("b")):
-            v = value[1:]
-        while(len(v) < self.alias_widths[alias]):
-            v = "0"+v
-        self.by_time [time][alias] = v
-        self.by_alias[alias][time] = v
+        self.signals[alias].append(time, value)
+
+    def addChanges(self, changes):
+        """
+        Add every (time, alias, value) tuple from an iterable of changes,
+        as yielded by VCDReader.changes with with_times set.
+        """
+        signals = self.signals
+        for time, alias, value in changes:
+            if(alias is None):
+                self.addTime(time)
+            else:
+                signals[alias].append(time, value)
+
+    def extend(self, other):
+        """
+        Append all of the times and changes held by another VCDValues,
+        which must all come after those already held by this one.
+        """
+        for time in other.times:
+            self.addTime(time)
+        for alias, sig in other.signals.items():
+            self.signals[alias].extend(sig)
+
+def resolve_signals(names_to_aliases, patterns):
+    """
+    Given a list of fully qualified signal names and/or glob patterns
+    over them, return the set of aliases they refer to.
+    """
+    tr = set()
+    for pattern in patterns:
+        if(pattern in names_to_aliases):
+            tr.add(names_to_aliases[pattern])
+        else:
+            for name in fnmatch.filter(names_to_aliases, pattern):
+                tr.add(names_to_aliases[name])
+    return tr
+
+def parse_changes(lines, until = None, with_times = False, aliases = None):
+    """
+    Generator which parses an iterable of lines from the value change
+    section of a VCD file. See VCDReader.changes.
+    """
+    current_time = 0
+
+    for line in lines:
+        l = line.strip()
+
+        if(not l):
+            continue
+
+        c = l[0]
+
+        if(c == "#"):
+            current_time = int(l[1:])
+            if(until is not None and current_time > until):
+                return
+            if(with_times):
+                yield (current_time, None, None)
+
+        elif(c == "$"):
+            # $dumpvars / $dumpall / $dumpon / $dumpoff / $end etc.
+            continue
+
+        elif(c in "bBrR"):
+            value, _, alias = l.partition(" ")
+            if(aliases is None or alias in aliases):
+                if(c in "bB"):
+                    value = value[1:]
+                yield (current_time, alias, value)
+
+        else:
+            alias = l[1:]
+            if(aliases is None or alias in aliases):
+                yield (current_time, alias, c)
+
+class VCDReader(object):
+    """
+    A streaming reader for Value Change Dump (VCD) Files. The header is
+    parsed as soon as the reader is opened, while the value changes are
+    only read from the file as they are asked for.
+    """
+
+    def __init__(self, vcd_file_path):
+        """
+        Open a VCD file and parse its header.
+        """
+        self.file_path          = vcd_file_path
+        self.top                = None
+        self.names_to_aliases   = {}
+        self.alias_widths       = {}
+        self.real_aliases       = set()
+
+        self.__fh__             = open(self.file_path, "r")
+        self.__parse_header__()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the underlying file handle.
+        """
+        self.__fh__.close()
+
+    def getSignalAlias(self, signalName):
+        """
+        Given a fully qualified signal name, return it's alias or None
+        if the signal does not exist in the VCD.
+        """
+        return self.names_to_aliases.get(signalName, None)
+
+    def resolveSignals(self, patterns):
+        """
+        Given a list of fully qualified signal names and/or glob patterns
+        over them, return the set of aliases they refer to.
+        """
+        return resolve_signals(self.names_to_aliases, patterns)
+
+    def changes(self, until = None, with_times = False, aliases = None):
+        """
+        Generator which yields every value change in the file as a
+        (time, alias, value) tuple, in file order. Vector values have
+        their leading "b" removed but are not padded.
+
+        Iteration stops after the last change at or before the time
+        "until", if given. When with_times is set, a (time, None, None)
+        tuple is also yielded for every timestamp in the file, even those
+        with no value changes. If a set of aliases is given, changes to
+        any other signal are skipped.
+
+        The file is read line by line, so the caller may stop iterating
+        at any point without the rest of the file being read.
+        """
+        return parse_changes(self.__fh__, until = until,
+                             with_times = with_times, aliases = aliases)
+
+    def __parse_header__(self):
+        """
+        Parse the VCD header, up to and including the $enddefinitions
+        command, leaving the file handle at the start of the value
+        changes.
+        """
+        current_scope   = None
+
+        while(True):
+            line = self.__fh__.readline()
+            if(not line):
+                break
+
+            l = line.strip()
+
+            if(l.startswith("$scope ")):
+                sname = l.split()[2]
+                new_scope = VCDScope(sname,parentScope = current_scope)
+                if(current_scope != None):
+                    current_scope.addChild(new_scope)
+                else:
+                    self.top = new_scope
+                current_scope = new_scope
+
+            elif(l.startswith("$var")):
+                s = l.split()
+                self.alias_widths[s[3]] = int(s[2])
+                if(s[1] == "real"):
+                    self.real_aliases.add(s[3])
+                current_scope.addSignal(s[4],s[3],int(s[2]))
+                fullname = current_scope.fullName()+"/"+s[4]
+                self.names_to_aliases[fullname] = s[3]
+
+            elif(l.startswith("$upscope")):
+                current_scope = current_scope.parent
+
+            elif(l.startswith("$enddefinitions")):
+                break
+
+            else:
+                pass
+
+
+class VCDVector(object):
+    """
+    A column of values sampled at every time on a VCDTimeline. Vectors
+    support element-wise arithmetic, comparison and bitwise operators
+    against other vectors on the same timeline or against constants, in
+    the style of NumPy arrays. Values which are unknown (X/Z, or not yet
+    assigned) are held as None and stay None through any operation.
+    """
+
+    __hash__ = None
+
+    def __init__(self, timeline, values, width = None):
+        """
+        Instance a new vector of values aligned with timeline.times.
+        """
+        self.timeline   = timeline
+        self.values     = values
+        self.width      = width
+
+    def __len__(self):
+        return len(self.values)
+
+    def __apply__(self, op, other, width = None):
+        """
+        Apply a binary operator element-wise, returning a new vector.
+        """
+        if(isinstance(other, VCDVector)):
+            rhs = other.values
+        else:
+            rhs = [other] * len(self.values)
+
+        return VCDVector(self.timeline,
+            [None if a is None or b is None else op(a, b)
+             for a, b in zip(self.values, rhs)], width)
+
+    def __eq__(self, other):
+        return self.__apply__(operator.eq, other)
+
+    def __ne__(self, other):
+        return self.__apply__(operator.ne, other)
+
+    def __lt__(self, other):
+        return self.__apply__(operator.lt, other)
+
+    def __le__(self, other):
+        return self.__apply__(operator.le, other)
+
+    def __gt__(self, other):
+        return self.__apply__(operator.gt, other)
+
+    def __ge__(self, other):
+        return self.__apply__(operator.ge, other)
+
+    def __and__(self, other):
+        return self.__apply__(operator.and_, other, self.width)
+
+    def __or__(self, other):
+        return self.__apply__(operator.or_, other, self.width)
+
+    def __xor__(self, other):
+        return self.__apply__(operator.xor, other, self.width)
+
+    def __add__(self, other):
+        return self.__apply__(operator.add, other)
+
+    def __sub__(self, other):
+        return self.__apply__(operator.sub, other)
+
+    def __rshift__(self, other):
+        return self.__apply__(operator.rshift, other, self.width)
+
+    def __invert__(self):
+        """
+        Logical not for boolean vectors, otherwise a bitwise not within
+        the width of the vector.
+        """
+        if(self.width is None):
+            op = operator.not_
+        else:
+            mask = (1 << self.width) - 1
+            op = lambda a: a ^ mask
+        return VCDVector(self.timeline,
+            [None if a is None else op(a) for a in self.values], self.width)
+
+    def bit(self, n):
+        """
+        Return a boolean vector of bit n of each value.
+        """
+        return VCDVector(self.timeline,
+            [None if a is None else bool((a >> n) & 1) for a in self.values])
+
+    def intervals(self):
+        """
+        Return a list of (start, end) tuples covering every time at which
+        the vector holds a true (known and non-zero) value. Adjacent
+        samples are merged, and the last sample runs until the end of the
+        dump.
+        """
+        times = self.timeline.times
+        ends  = list(times[1:]) + [self.timeline.end]
+        tr    = []
+
+        for start, end, v in zip(times, ends, self.values):
+            if(not v or end <= start):
+                continue
+            elif(tr and tr[-1][1] == start):
+                tr[-1] = (tr[-1][0], end)
+            else:
+                tr.append((start, end))
+
+        return tr
+
+    def duration(self):
+        """
+        Return the total time for which the vector holds a true value.
+        """
+        return sum([end - start for start, end in self.intervals()])
+
+
+class VCDTimeline(object):
+    """
+    Aligns several signals onto a common timeline, made up of the union
+    of their change times, so that expressions across the signals can be
+    evaluated as element-wise VCDVector operations.
+    """
+
+    def __init__(self, vcd, signals):
+        """
+        Align the given signals, named by full name or by alias, from a
+        parsed VCDFile.
+        """
+        self.vcd     = vcd
+        self.end     = vcd.values.times[-1] if len(vcd.values.times) else 0
+
+        sigs = {}
+        for name in signals:
+            alias = vcd.getSignalAlias(name)
+            sigs[name] = vcd.values.signals[alias if alias else name]
+
+        times = set()
+        for sig in sigs.values():
+            times.update(sig.times)
+        self.times = array("Q", sorted(times))
+
+        self.columns = {}
+        for name, sig in sigs.items():
+            self.columns[name] = VCDVector(self, self.__align__(sig),
+                                           sig.width)
+
+    def __getitem__(self, name):
+        """
+        Return the aligned VCDVector for a signal.
+        """
+        return self.columns[name]
+
+    def __align__(self, sig):
+        """
+        Return the values of a signal sampled at every time on the
+        timeline. X/Z and unassigned values become None.
+        """
+        tr = []
+        j  = -1
+        n  = len(sig.times)
+
+        for t in self.times:
+            while(j + 1 < n and sig.times[j + 1] <= t):
+                j += 1
+            if(j < 0 or j in sig.xz):
+                tr.append(None)
+            else:
+                tr.append(sig.values[j])
+
+        return tr
+
 
 class VCDFile(object):
     """
     A simple python class for reading Value Change Dump (VCD) Files.
     """
 
-    def __init__(self, vcd_file_path):
+    def __init__(self, vcd_file_path, signals = None, cache = True,
+                 jobs = 1):
         """
-        Open a new VCD file for analysis.
+        Open a new VCD file for analysis. If a list of fully qualified
+        signal names or glob patterns is given, only the values of the
+        matching signals are loaded.
+
+        If cache is set, the parsed file is loaded from (or, after a full
+        parse, written to) a binary cache file next to the VCD. The cache
+        is ignored and re-built whenever the VCD file changes.
+
+        If jobs is more than one, the value changes are parsed in parallel
+        by that many worker processes.
         """
         self.file_path = vcd_file_path
+        self.signals   = signals
+        self.jobs      = jobs
         self.values    = VCDValues()
         self.top       = None
         self.names_to_aliases = {}
+        self.cache_path = vcd_file_path + CACHE_SUFFIX
+        self.__cache_map__ = None
+
+        if(cache and self.__load_cache__()):
+            return
+
         self.__parse__()
 
+        if(cache and signals is None):
+            try:
+                self.__write_cache__()
+            except (IOError, OSError):
+                pass    # Caching is only ever an optimisation.
+
     def getSignalAlias(self, signalName):
         """
         Given a fully qualified signal name, return it's alias or None
@@ -124,89 +726,262 @@ class VCDFile(object):
         Return a list of time ranges (expressed as tuples) which
         define when the given alias has a particular value.
         """
-        tr = []
-        vt = self.getValuesByTimeForAlias(alias)
-        prev_time = 0
-        prev_val  = None
+        return self.values.signals[alias].intervals_when(value)
 
-        times = sorted(vt.keys())
-        
-        for i in range(0, len(times)-1):
-            time = times[i]
-            if(vt[time] == value):
-                tr.append((time, times[i+1]))
+    def value_at(self, alias, time):
+        """
+        Return the value of the given alias at a particular time, or None
+        if it has not been assigned by then. See VCDSignal.value.
+        """
+        return self.values.signals[alias].value_at(time)
 
-        return tr
+    def changes_between(self, alias, start, end):
+        """
+        Return a list of (time, value) tuples for every change to the
+        given alias in the half open time interval [start, end).
+        """
+        return self.values.signals[alias].changes_between(start, end)
+
+    def timeline(self, signals):
+        """
+        Return a VCDTimeline which aligns the given signals, named by
+        full name or alias, for evaluating expressions over them. E.g.
+
+            t = vcd.timeline(["top/mem_c_en", "top/mem_stall"])
+            stalls = (t["top/mem_c_en"] == 1) & (t["top/mem_stall"] == 0)
+            stalls.intervals()
+        """
+        return VCDTimeline(self, signals)
 
     def getValuesByTimeForAlias(self,alias):
         """
         For a given signal alias, return a dictionary of its values
         keyed by times.
         """
-        return self.values.by_alias[alias]
+        sig = self.values.signals[alias]
+        return dict([(sig.times[i], sig.render(i)) for i in range(len(sig))])
         
     def getValuesForAlias(self,alias):
         """
-        For a given signal alias, return a dictionary of its values only
+        For a given signal alias, return a list of its values only
         without timestamps.
         """
-        return self.values.by_alias[alias].values()
+        sig = self.values.signals[alias]
+        return [sig.render(i) for i in range(len(sig))]
 
     def __parse__(self):
         """
         Parse the VCD file path in self.file_path
         """
 
-        with open(self.file_path,"r") as fh:
-            
-            current_scope   = None
-            current_time    = 0
-            parse_vars      = False
-            
-            self.values.addTime(current_time)
-
-            for line in fh.readlines():
-                l = line.rstrip(" \n").strip(" ")
-                
-                if(parse_vars):
-                    if(l.startswith("#")):
-                        current_time = int(l[1:])
-                        self.values.addTime(current_time)
-                    elif(l != "$end"):
-                        alias = l[1:]
-                        value = l[0]
-                        s = l.split(" ")
-                        if(len(s) == 2):
-                            alias = s[1]
-                            value = s[0]
-                        self.values.addValue(current_time, 
-                                             alias,
-                                             value)
-
-                elif(l.startswith("$scope ")):
-                    sname = l.split(" ")[2]
-                    new_scope = VCDScope(sname,parentScope = current_scope)
-                    if(current_scope != None):
-                        current_scope.addChild(new_scope)
-                    else:
-                        self.top = new_scope
-                    current_scope = new_scope
-
-                elif(l.startswith("$var")):
-                    s = l.split(" ")
-                    self.values.addAlias(s[3], int(s[2]))
-                    current_scope.addSignal(s[4],s[3],int(s[2]))
-                    fullname = current_scope.fullName()+"/"+s[4]
-                    self.names_to_aliases[fullname] = s[3]
-
-                elif(l.startswith("$upscope")):
-                    current_scope = current_scope.parent
-
-                elif(l.startswith("$dumpvars")):
-                    parse_vars = True
+        with VCDReader(self.file_path) as reader:
 
-                else:
-                    pass
+            self.top              = reader.top
+            self.names_to_aliases = reader.names_to_aliases
+
+            aliases = None
+            if(self.signals is not None):
+                aliases = reader.resolveSignals(self.signals)
+
+            for alias in reader.alias_widths:
+                if(aliases is None or alias in aliases):
+                    self.values.addAlias(alias, reader.alias_widths[alias],
+                        real = alias in reader.real_aliases)
+
+            self.values.addTime(0)
+
+            if(self.jobs > 1):
+                self.__parse_parallel__(aliases)
+            else:
+                self.values.addChanges(reader.changes(with_times = True,
+                                                      aliases = aliases))
+
+    def __parse_parallel__(self, aliases):
+        """
+        Parse the value change section of the file in chunks, using a pool
+        of self.jobs worker processes. The file is memory mapped and split
+        on timestamp lines, so each chunk can be parsed independently. The
+        per-chunk columns are then appended together in file order.
+        """
+        with open(self.file_path, "rb") as fh:
+            cmap = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+
+        start = cmap.find(b"$enddefinitions")
+        start = cmap.find(b"\n", start) + 1 if start >= 0 else len(cmap)
+        end   = len(cmap)
+
+        nchunks = max(self.jobs, (end - start) // PARALLEL_CHUNK_SIZE + 1)
+        bounds  = [start]
+        for i in range(1, nchunks):
+            split = cmap.find(b"\n#", start + (end - start) * i // nchunks)
+            if(split < 0):
+                break
+            if(split + 1 > bounds[-1]):
+                bounds.append(split + 1)
+        bounds.append(end)
+
+        cmap.close()
+
+        widths = {}
+        for alias, sig in self.values.signals.items():
+            widths[alias] = (sig.width, sig.real)
+
+        work = [(self.file_path, bounds[i], bounds[i+1], widths, aliases)
+                for i in range(len(bounds) - 1)]
+
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            for chunk in pool.imap(__parse_chunk__, work):
+                self.values.extend(chunk)
+        finally:
+            pool.close()
+            pool.join()
+
+    def __cache_key__(self):
+        """
+        Return the dictionary used to check a cache file is up to date
+        with the VCD file it was built from.
+        """
+        st = os.stat(self.file_path)
+        return {"path"  : os.path.abspath(self.file_path),
+                "size"  : st.st_size,
+                "mtime" : st.st_mtime_ns}
+
+    def __write_cache__(self):
+        """
+        Write the scope tree, alias table and value columns to the cache
+        file at self.cache_path.
+
+        The file is a magic number, the length of a JSON header, the JSON
+        header itself, then the raw time and value columns of every signal
+        at 8 byte aligned offsets recorded in the header. Values of very
+        wide signals and X/Z masks are stored in the header.
+        """
+        columns = []
+        offset  = [0]
+
+        def place(column):
+            columns.append(column)
+            tr = offset[0]
+            offset[0] += len(column) * column.itemsize
+            return tr
+
+        signals = {}
+        for alias, sig in self.values.signals.items():
+            d = {"width"    : sig.width,
+                 "real"     : sig.real,
+                 "count"    : len(sig),
+                 "times"    : place(sig.times),
+                 "xz"       : sig.xz}
+            if(isinstance(sig.values, list)):
+                d["values"] = None
+                d["wide"]   = sig.values
+            else:
+                d["values"] = place(sig.values)
+            signals[alias] = d
+
+        header = json.dumps({
+            "key"               : self.__cache_key__(),
+            "byteorder"         : sys.byteorder,
+            "top"               : self.top.toDict() if self.top else None,
+            "names_to_aliases"  : self.names_to_aliases,
+            "times"             : [place(self.values.times),
+                                   len(self.values.times)],
+            "signals"           : signals
+        }).encode("utf-8")
+
+        base = len(CACHE_MAGIC) + 8 + len(header)
+        pad  = (8 - base % 8) % 8
+
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(CACHE_MAGIC)
+            fh.write(struct.pack("<Q", len(header) + pad))
+            fh.write(header)
+            fh.write(b" " * pad)
+            for column in columns:
+                fh.write(column)
+
+        os.replace(tmp_path, self.cache_path)
+
+    def __load_cache__(self):
+        """
+        Try to load the parsed VCD from the cache file. The value columns
+        are memory mapped rather than read. Returns False if there is no
+        usable, up to date cache.
+        """
+        try:
+            with open(self.cache_path, "rb") as fh:
+                cmap = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return False
+
+        view = memoryview(cmap)
+
+        try:
+            if(bytes(view[0:len(CACHE_MAGIC)]) != CACHE_MAGIC):
+                return False
+            hlen, = struct.unpack_from("<Q", cmap, len(CACHE_MAGIC))
+            base  = len(CACHE_MAGIC) + 8
+            header= json.loads(bytes(view[base:base+hlen]).decode("utf-8"))
+            base += hlen
+        except (struct.error, ValueError):
+            return False
+
+        if(header["key"] != self.__cache_key__() or
+           header["byteorder"] != sys.byteorder):
+            return False
+
+        def column(start, count, typecode):
+            start += base
+            return view[start:start + count * 8].cast(typecode)
+
+        self.__cache_map__    = cmap
+        self.names_to_aliases = header["names_to_aliases"]
+        if(header["top"] is not None):
+            self.top = VCDScope.fromDict(header["top"])
+
+        aliases = None
+        if(self.signals is not None):
+            aliases = resolve_signals(self.names_to_aliases, self.signals)
+
+        self.values.times = column(header["times"][0], header["times"][1],
+                                   "Q")
+
+        for alias, d in header["signals"].items():
+            if(aliases is not None and alias not in aliases):
+                continue
+            self.values.addAlias(alias, d["width"], real = d["real"])
+            sig = self.values.signals[alias]
+            sig.times = column(d["times"], d["count"], "Q")
+            if(d["values"] is None):
+                sig.values = d["wide"]
+            else:
+                sig.values = column(d["values"], d["count"],
+                                    "d" if d["real"] else "Q")
+            sig.xz = dict([(int(i), m) for i, m in d["xz"].items()])
+
+        return True
+
+def __parse_chunk__(work):
+    """
+    Worker process function for VCDFile.__parse_parallel__. Parses the
+    value changes between two byte offsets of a VCD file into a new
+    VCDValues object.
+    """
+    file_path, start, end, widths, aliases = work
+
+    tr = VCDValues()
+    for alias, (width, real) in widths.items():
+        tr.addAlias(alias, width, real = real)
+
+    with open(file_path, "rb") as fh:
+        cmap = mmap.mmap(fh.fileno(), 0, access = mmap.ACCESS_READ)
+        lines = cmap[start:end].decode("ascii").splitlines()
+        cmap.close()
+
+    tr.addChanges(parse_changes(lines, with_times = True, aliases = aliases))
+    return tr
 
 def main():
     vcd = VCDFile(sys.argv[1])
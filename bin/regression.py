@@ -8,8 +8,27 @@ tests.
 import os
 import sys
 import csv
+import json
+import time
+import datetime
+import heapq
 import shutil
+import hashlib
+import argparse
+import threading
+import collections
+import functools
 import subprocess
+import multiprocessing
+import multiprocessing.pool
+import xml.etree.ElementTree as ElementTree
+
+import pysyms
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 RED   = "\033[1;31m"  
 BLUE  = "\033[1;34m"
@@ -19,6 +38,115 @@ RESET = "\033[0;0m"
 BOLD    = "\033[;1m"
 REVERSE = "\033[;7m"
 
+#: The verilated simulation executable built by "make verilate".
+SIMULATOR = os.path.join("work","obj_dir","Vrvm_core_axi4")
+
+#: Choices for when to dump waves. See run_test.
+WAVE_MODES = ["all", "fail", "none"]
+
+#: Where cached test results, logs and coverage databases are kept.
+CACHE_DIR = os.path.join("work","regress-cache")
+
+#: Only these results are deterministic enough to be cached.
+CACHED_RESULTS = ["PASSED", "FAILED"]
+
+#: Wall clock runtimes of tests from previous runs, used to balance shards.
+TIMES_FILE = os.path.join("work","regress-times.json")
+
+#: Where each shard writes its results by default. See run_regressions.
+RESULTS_DIR = os.path.join("work","regress-results")
+
+#: Each run appends a summary of its simulation throughput to this file.
+HISTORY_FILE = os.path.join("work","regress-history.jsonl")
+
+#: Warn if throughput falls below this fraction of its recent median.
+THROUGHPUT_TOLERANCE = 0.8
+
+#: How many previous runs the throughput is compared against.
+THROUGHPUT_WINDOW = 10
+
+#: The verilator_coverage executable used to merge coverage databases.
+COVERAGE_TOOL = os.environ.get("RVM_VERILATOR_COV", "verilator_coverage")
+
+#: Where partially merged coverage databases are kept while merging.
+COV_MERGE_DIR = os.path.join("work","cov-merge")
+
+#: The most simulator output kept in each test log, in bytes.
+MAX_LOG_BYTES = 1 << 20
+
+#: Lines of simulator output which decide the result of a test. The first
+#: one seen wins.
+RESULT_MARKERS = [("TIMEOUT"  , "TIMEOUT"),
+                  ("TEST PASS", "PASSED"),
+                  ("TEST FAIL", "FAILED")]
+
+#: The simulator prints the number of cycles it simulated after this.
+CYCLES_MARKER = "Simulated cycles: "
+
+#: Where tests write their instruction retire traces. See bin/pytrace.py.
+RETIRE_TRACE_DIR = os.path.join("work","retire")
+
+#: When a test which timed out is re-run with waves, only this many cycles
+#: are kept in each of the two rotating wave segments. See +WAVE_RING.
+TIMEOUT_WAVE_RING = 10000
+
+class SimulatorLog(object):
+    """
+    Keeps the head and tail of the output of a simulator run, up to a
+    maximum size in bytes, dropping the middle of very long logs.
+    """
+
+    def __init__(self, max_bytes = MAX_LOG_BYTES):
+        self.max_bytes  = max_bytes
+        self.head       = []
+        self.head_bytes = 0
+        self.tail       = collections.deque()
+        self.tail_bytes = 0
+        self.dropped    = 0
+
+    def append(self, line):
+        """
+        Add a line of output to the log.
+        """
+        if(self.head_bytes < self.max_bytes // 2):
+            self.head.append(line)
+            self.head_bytes += len(line)
+        else:
+            self.tail.append(line)
+            self.tail_bytes += len(line)
+            while(self.tail_bytes > self.max_bytes // 2):
+                self.tail_bytes -= len(self.tail.popleft())
+                self.dropped    += 1
+
+    def __str__(self):
+        dropped = []
+        if(self.dropped):
+            dropped = ["... %d lines dropped ...\n" % self.dropped]
+        return "".join(self.head + dropped + list(self.tail))
+
+def file_digest(path):
+    """
+    Return the SHA1 hex digest of the contents of a file.
+    """
+    h = hashlib.sha1()
+    with open(path,"rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def memory_image(hex_file):
+    """
+    Return the memory image the simulator should load for a hex file. This
+    is the binary image hexmem-refactor.py writes next to it, which the
+    simulator maps into memory rather than parses, unless there is none
+    or it is older than the hex file.
+    """
+    bin_file = os.path.splitext(hex_file)[0] + ".bin"
+    if(os.path.isfile(bin_file) and os.path.isfile(hex_file) and
+       os.path.getmtime(bin_file) >= os.path.getmtime(hex_file)):
+        return bin_file
+    return hex_file
+
 class RegressionTest(object):
     """
     A simple holder to describe a single regression test.
@@ -28,55 +156,265 @@ class RegressionTest(object):
                        pass_addr, 
                        dis_file=None,
                        fail_addr=None,
-                       halt_addr=None):
+                       halt_addr=None,
+                       max_cycles=None,
+                       symbols=None):
         """
-        Instance a new regression test.
+        Instance a new regression test. Symbols is a pysyms.SymbolIndex
+        used to look up the pass/fail addresses in the disassembly.
         """
         self.hex_file    = os.path.expandvars(hex_file) 
+        self.image_file  = memory_image(self.hex_file)
         self.dis_file    = os.path.expandvars(dis_file) 
         self.pass_addr   = pass_addr
         self.fail_addr   = fail_addr
         self.halt_addr   = halt_addr
+        self.max_cycles  = max_cycles
+        self.name        = os.path.basename(self.hex_file).split(".")[0]
         self.cov_db      = os.path.join("work","cov-db",
                                         os.path.basename(self.hex_file)+".cov")
+        self.vcd_file    = os.path.join("work","vcd", self.name+".vcd")
+        self.log_file    = os.path.join("work","logs", self.name+".log")
+        self.trace_file  = None
 
         self.result      = None
-        self.result_str  = "      "
-        self.__infer_pass_fail_addr__()
+        self.result_str  = "       "
+        self.digest      = None
+        self.cached      = False
+        self.runtime     = None
+        self.sim_runtime = None
+        self.cycles      = None
+        self.returncode  = None
+        self.killed      = False
+        self.log         = None
+        self.__infer_pass_fail_addr__(symbols)
 
 
-    def __infer_pass_fail_addr__(self):
+    def __infer_pass_fail_addr__(self, symbols = None):
         """
-        Try and automatically work out the pass/fail address from the
+        Try and automatically work out the pass/fail/halt address from the
         dissassembly.
         """
-        if(os.path.isfile(self.dis_file)):
-            with open(self.dis_file,"r") as fh:
-                for line in fh.readlines():
-                    if " <pass>:" in line:
-                        self.pass_addr = line.split(" ")[0]
-                    elif " <fail>:" in line:
-                        self.fail_addr = line.split(" ")[0]
+        if(symbols is None):
+            symbols = pysyms.SymbolIndex(index_file = None)
+
+        dis = symbols.get(self.dis_file)
+        if(dis is None):
+            return
+
+        for name in ["pass", "fail", "halt"]:
+            addr = dis.address_of(name)
+            if(addr is not None):
+                setattr(self, name+"_addr", "%08x" % addr)
 
 
     def __str__(self):
-        return "%s | %s | %s | %s | %s" % (self.result_str,
+        return "%s | %s | %s | %s | %s%s" % (self.result_str,
             self.pass_addr,
             self.fail_addr,
             self.halt_addr,
-            self.hex_file)
+            self.hex_file,
+            " (cached)" if self.cached else "")
+
+    def input_digest(self, sim_digest):
+        """
+        Return a digest of everything which can change the result of the
+        test: the simulator, the memory image it loads, and the addresses
+        and cycle limit it is run with.
+        """
+        h = hashlib.sha1()
+        h.update(sim_digest.encode("ascii"))
+        h.update(file_digest(self.image_file).encode("ascii"))
+        h.update(("%s %s %s %s" % (self.pass_addr, self.fail_addr,
+                                   self.halt_addr, self.max_cycles)
+                 ).encode("ascii"))
+        return h.hexdigest()
+
+    def cache_path(self, extension):
+        """
+        Return the path of this test's entry in the result cache.
+        """
+        return os.path.join(CACHE_DIR, self.digest + extension)
+
+    def load_cached(self):
+        """
+        Restore the result, log and coverage database of this test from
+        the result cache. Returns False if there is no cached result.
+        """
+        if(not self.digest or not os.path.isfile(self.cache_path(".json"))):
+            return False
+
+        with open(self.cache_path(".json"),"r") as fh:
+            record = json.load(fh)
+
+        for ext, path in [(".cov", self.cov_db), (".log", self.log_file)]:
+            if(os.path.isfile(self.cache_path(ext))):
+                shutil.copyfile(self.cache_path(ext), path)
+
+        self.restore_result(record["result"])
+        self.cycles     = record.get("cycles")
+        self.returncode = record.get("exit_status")
+
+        self.cached = True
+        return True
+
+    def save_cached(self):
+        """
+        Store the result, log and coverage database of this test in the
+        result cache, if the result is one which can be cached.
+        """
+        if(not self.digest or self.result not in CACHED_RESULTS):
+            return
+
+        # Other processes may be reading the cache, so each file is
+        # written under a temporary name and then renamed into place. The
+        # .json file goes last, as load_cached looks for it first.
+        tmp_suffix = ".tmp.%d" % os.getpid()
+
+        for ext, path in [(".cov", self.cov_db), (".log", self.log_file)]:
+            if(os.path.isfile(path)):
+                shutil.copyfile(path, self.cache_path(ext) + tmp_suffix)
+                os.rename(self.cache_path(ext) + tmp_suffix,
+                          self.cache_path(ext))
+
+        with open(self.cache_path(".json") + tmp_suffix,"w") as fh:
+            json.dump({"result"     : self.result,
+                       "hex_file"   : self.hex_file,
+                       "cycles"     : self.cycles,
+                       "exit_status": self.returncode}, fh)
+        os.rename(self.cache_path(".json") + tmp_suffix,
+                  self.cache_path(".json"))
+
+    def artefacts(self):
+        """
+        Return the paths of the waves and retire trace which runs of this
+        test may write. These are too big to keep in the result cache.
+        """
+        return [path for path in [self.vcd_file, self.trace_file] if path]
+
+    def artefact_current(self, path):
+        """
+        Return True if the file at path was written by a run of this test
+        with its current input digest, as recorded by mark_artefacts.
+        """
+        if(not self.digest or not os.path.isfile(path) or
+           not os.path.isfile(path + ".digest")):
+            return False
+        with open(path + ".digest","r") as fh:
+            return fh.read().strip() == self.digest
+
+    def mark_artefacts(self):
+        """
+        Record the input digest of the run which wrote each of the waves
+        and retire trace of this test in a "<path>.digest" file next to
+        it, so a cached result is never shown with those of another run.
+        """
+        for path in self.artefacts():
+            if(self.digest and os.path.isfile(path)):
+                with open(path + ".digest","w") as fh:
+                    fh.write(self.digest + "\n")
+            elif(os.path.isfile(path + ".digest")):
+                os.remove(path + ".digest")
+
+    def remove_artefacts(self, paths = None):
+        """
+        Delete the given artefacts of this test, or all of them, along
+        with their digests and any earlier wave segment.
+        """
+        for path in (self.artefacts() if paths is None else paths):
+            for stale in [path, path + ".digest", path + ".prev"]:
+                if(os.path.isfile(stale)):
+                    os.remove(stale)
+
+    def sim_command(self, simulator = SIMULATOR, waves = True,
+                    wave_ring = None):
+        """
+        Return the argument vector used to run this test on the given
+        simulator executable, with or without dumping waves. If wave_ring
+        is given, only that many cycles of waves are kept in each of two
+        rotating segments.
+        """
+        cmd = [simulator,
+               os.path.abspath(self.vcd_file) if waves else "-",
+               self.image_file,
+               self.pass_addr,
+               self.fail_addr,
+               self.cov_db]
+        if(self.max_cycles):
+            cmd.append("+MAX_CYCLES=%d" % self.max_cycles)
+        if(self.trace_file):
+            cmd.append("+RETIRE_TRACE=%s" % os.path.abspath(self.trace_file))
+        if(waves and wave_ring):
+            cmd.append("+WAVE_RING=%d" % wave_ring)
+        return cmd
 
     def passed(self,output):
         self.result="PASSED"
-        self.result_str=GREEN+"PASSED"+RESET
+        self.result_str=GREEN+"PASSED "+RESET
 
     def failed(self,output):
         self.result="FAILED"
-        self.result_str=RED  +"FAILED"+RESET
+        self.result_str=RED  +"FAILED "+RESET
 
     def errored(self,exception):
         self.result="ERROR "
-        self.result_str=RED+"ERROR "+RESET
+        self.result_str=RED+"ERROR  "+RESET
+
+    def timedout(self,output):
+        self.result="TIMEOUT"
+        self.result_str=RED+"TIMEOUT"+RESET
+
+    def cycles_per_second(self):
+        """
+        Return the simulation throughput of the last run of this test, or
+        None if it is not known.
+        """
+        if(self.cycles and self.sim_runtime):
+            return self.cycles / self.sim_runtime
+        return None
+
+    def record(self):
+        """
+        Return a dictionary describing the result and timing of the test,
+        as written to result files.
+        """
+        return {"name"             : self.name,
+                "hex_file"         : self.hex_file,
+                "result"           : self.result,
+                "exit_status"      : self.returncode,
+                "killed"           : self.killed,
+                "cached"           : self.cached,
+                "wall_time"        : self.runtime,
+                "sim_wall_time"    : self.sim_runtime,
+                "cycles"           : self.cycles,
+                "cycles_per_second": self.cycles_per_second()}
+
+    def restore_record(self, record):
+        """
+        Restore the result and timing of the test from a dictionary made
+        by record.
+        """
+        self.restore_result(record["result"])
+        self.returncode  = record["exit_status"]
+        self.killed      = record.get("killed", False)
+        self.cached      = record["cached"]
+        self.runtime     = record["wall_time"]
+        self.sim_runtime = record["sim_wall_time"]
+        self.cycles      = record["cycles"]
+
+    def restore_result(self, result):
+        """
+        Set the result of the test from a result string saved by an
+        earlier run.
+        """
+        if(result == "PASSED"):
+            self.passed(None)
+        elif(result == "FAILED"):
+            self.failed(None)
+        elif(result == "TIMEOUT"):
+            self.timedout(None)
+        else:
+            self.errored(None)
                                                                 
 
 def load_db(file_path):
@@ -84,7 +422,8 @@ def load_db(file_path):
     Load and return the CSV database
     """
 
-    tr = []
+    tr      = []
+    symbols = pysyms.SymbolIndex()
 
     with open(file_path,"r") as fh:
         reader = csv.DictReader(fh,delimiter=",")
@@ -95,65 +434,862 @@ def load_db(file_path):
             pass_addr   = row["pass"].rstrip("\n ").lstrip(" ")
             fail_addr   = row["fail"].rstrip("\n ").lstrip(" ")
             halt_addr   = row["halt"].rstrip("\n ").lstrip(" ")
+            max_cycles  = (row.get("cycles") or "").strip(" ")
             tr.append(RegressionTest(hex_file, pass_addr,
                                      dis_file  = dis_file,
                                      halt_addr = halt_addr,
-                                     fail_addr = fail_addr))
+                                     fail_addr = fail_addr,
+                                     max_cycles= int(max_cycles or 0),
+                                     symbols   = symbols))
+
+    symbols.save()
 
     return tr
 
-def run_regressions(to_run):
+def load_times(file_path = TIMES_FILE):
     """
-    Takes a list of RegressionTest objects and runs them in order.
+    Load the recorded runtime in seconds of each test, keyed by hex file.
+    Returns an empty dictionary if nothing has been recorded yet.
     """
-    
-    vcd_dir = os.path.join("work","vcd")
-    cov_dir = os.path.join("work","cov-db")
+    if(not os.path.isfile(file_path)):
+        return {}
+    with open(file_path,"r") as fh:
+        return json.load(fh)
 
-    if(not os.path.isdir(vcd_dir)):
-        os.makedirs(vcd_dir)
+def save_times(tests, file_path = TIMES_FILE):
+    """
+    Add the runtimes of the given tests to the recorded runtimes. Tests
+    which were not simulated (e.g. cached results) keep their old times.
+    """
+    times = load_times(file_path)
+    for test in tests:
+        if(test.runtime is not None):
+            times[test.hex_file] = round(test.runtime, 3)
 
-    if(not os.path.isdir(cov_dir)):
-        os.makedirs(cov_dir)
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path,"w") as fh:
+        json.dump(times, fh, indent=1, sort_keys=True)
+    os.rename(tmp_path, file_path)
 
-    print("RESULT | PASS       | FAIL       | HALT       | TEST")
-    print("-------|------------|------------|------------|--------------------")
-    i = 0
-    for test in to_run:
+def estimate_runtimes(tests, times):
+    """
+    Return the expected runtime of each test. Tests without a recorded
+    runtime are estimated from the size of their hex file, scaled by the
+    seconds per byte of the tests which have one.
+    """
+    sizes = [os.path.getsize(t.hex_file) if os.path.isfile(t.hex_file)
+             else 0 for t in tests]
+
+    known_time = sum(times[t.hex_file] for t in tests if t.hex_file in times)
+    known_size = sum(size for t, size in zip(tests, sizes)
+                     if t.hex_file in times)
+    scale = float(known_time) / known_size if known_time and known_size else 1.0
+
+    return [times.get(t.hex_file, size * scale)
+            for t, size in zip(tests, sizes)]
+
+def shard_tests(tests, index, count, times):
+    """
+    Split tests into "count" shards with about the same total runtime,
+    and return the tests in shard "index" (counting from 1), in their
+    original order.
+
+    Tests are dealt longest first to whichever shard has the least work
+    so far. The split only depends on the test list and times, so every
+    host given the same ones agrees on it.
+    """
+    costs  = estimate_runtimes(tests, times)
+    order  = sorted(range(len(tests)),
+                    key = lambda i: (-costs[i], tests[i].hex_file))
+    shards = [(0.0, shard) for shard in range(count)]
+    owner  = {}
+
+    for i in order:
+        load, shard = heapq.heappop(shards)
+        owner[i]    = shard
+        heapq.heappush(shards, (load + costs[i], shard))
+
+    return [t for i, t in enumerate(tests) if owner[i] == index - 1]
+
+def write_results(tests, file_path):
+    """
+    Write the results of a set of tests to a JSON file, one record per
+    test. These files can be merged by merge_results.
+    """
+    with open(file_path,"w") as fh:
+        json.dump({"tests": [t.record() for t in tests]}, fh, indent=1,
+                  sort_keys=True)
+
+def write_junit(tests, file_path):
+    """
+    Write the results of a set of tests to a JUnit XML file. Failures and
+    errors carry the path of the test's log. Tests without a result are
+    reported as skipped.
+    """
+    suite = ElementTree.Element("testsuite", name = "regression")
+    counts = collections.Counter()
+
+    for test in tests:
+        case = ElementTree.SubElement(suite, "testcase",
+                                      classname = "regression",
+                                      name      = test.name,
+                                      file      = test.hex_file,
+                                      time      = "%.3f" % (test.runtime or 0))
+        if(test.result is None):
+            ElementTree.SubElement(case, "skipped")
+            counts["skipped"] += 1
+        elif(test.result == "FAILED"):
+            ElementTree.SubElement(case, "failure", message = test.result,
+                                   type = "exit %s" % test.returncode
+                                   ).text = test.log_file
+            counts["failures"] += 1
+        elif(test.result != "PASSED"):
+            ElementTree.SubElement(case, "error", message = test.result,
+                                   type = "exit %s" % test.returncode
+                                   ).text = test.log_file
+            counts["errors"] += 1
+        props = ElementTree.SubElement(case, "properties")
+        for prop in ["exit_status", "cycles", "cycles_per_second"]:
+            if(test.record()[prop] is not None):
+                ElementTree.SubElement(props, "property", name = prop,
+                                       value = str(test.record()[prop]))
+
+    suite.set("tests", str(len(tests)))
+    for count in ["failures", "errors", "skipped"]:
+        suite.set(count, str(counts[count]))
+    suite.set("time", "%.3f" % sum(t.runtime or 0 for t in tests))
+
+    ElementTree.ElementTree(suite).write(file_path, encoding = "utf-8")
+
+def git_commit():
+    """
+    Return the commit the working tree is at, or None if it is unknown.
+    """
+    try:
+        with open(os.devnull, "w") as null:
+            return subprocess.check_output(["git","rev-parse","HEAD"],
+                                           stderr = null,
+                                           universal_newlines = True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def append_history(tests, file_path = HISTORY_FILE):
+    """
+    Append a summary of the simulation throughput of the tests which were
+    simulated to completion in this run to the history file, and warn if
+    it has fallen well below its median over the last few runs.
+
+    Runs may simulate different sets of tests, so each test is compared
+    with its own throughput in the last few runs which simulated it. The
+    warning is given if the median of those ratios is too low.
+    """
+    simulated = [t for t in tests if t.cycles_per_second() and
+                 t.result in ["PASSED", "FAILED"]]
+    if(not simulated):
+        return
+
+    cycles  = sum(t.cycles for t in simulated)
+    seconds = sum(t.sim_runtime for t in simulated)
+    entry   = {"date"             : datetime.datetime.now().isoformat(),
+               "commit"           : git_commit(),
+               "tests"            : len(simulated),
+               "cycles"           : cycles,
+               "sim_wall_time"    : round(seconds, 3),
+               "cycles_per_second": cycles / seconds,
+               "per_test"         : dict((t.hex_file, t.cycles_per_second())
+                                         for t in simulated)}
+
+    previous = []
+    if(os.path.isfile(file_path)):
+        with open(file_path,"r") as fh:
+            previous = [json.loads(line) for line in fh if line.strip()]
+
+    ratios = []
+    for hex_file, rate in entry["per_test"].items():
+        rates = [e["per_test"][hex_file] for e in previous
+                 if e.get("per_test", {}).get(hex_file)]
+        rates = sorted(rates[-THROUGHPUT_WINDOW:])
+        if(rates):
+            ratios.append(rate / rates[len(rates) // 2])
+
+    if(ratios):
+        ratio = sorted(ratios)[len(ratios) // 2]
+        if(ratio < THROUGHPUT_TOLERANCE):
+            print("%sThroughput is %.0f%% of its recent median for the same "
+                  "%d tests%s" % (RED, 100 * ratio, len(ratios), RESET))
+
+    with open(file_path,"a") as fh:
+        fh.write(json.dumps(entry, sort_keys=True) + "\n")
+
+def merge_results(tests, result_files, times_file = TIMES_FILE,
+                  junit_file = None, history_file = HISTORY_FILE):
+    """
+    Fill in the results of tests from the result files written by each
+    shard, print them in the order of tests, and add the runtimes of the
+    shards to the recorded runtimes. Tests no shard ran are printed
+    without a result. The merged results are written to junit_file as
+    JUnit XML, and the throughput of the whole run appended to
+    history_file, if given.
+    """
+    by_hex = dict((t.hex_file, t) for t in tests)
+
+    for file_path in result_files:
+        with open(file_path,"r") as fh:
+            records = json.load(fh)["tests"]
+        for record in records:
+            test = by_hex.get(record["hex_file"])
+            if(test):
+                test.restore_record(record)
+
+    print("RESULT  | PASS       | FAIL       | HALT       | TEST")
+    print("--------|------------|------------|------------|--------------------")
+
+    for test in tests:
+        print(str(test))
+
+    if(times_file):
+        save_times(tests, times_file)
+
+    if(junit_file):
+        write_junit(tests, junit_file)
+
+    if(history_file):
+        append_history(tests, history_file)
+
+def run_test(test, simulator = SIMULATOR, timeout = None, waves = "fail",
+             force = False, server = False):
+    """
+    Run a single RegressionTest, recording the result in the test object,
+    which is then returned. Every test writes its own VCD, coverage
+    database and simulator log, so tests may be run in parallel.
+
+    Waves are dumped for every run if waves is "all", and never if it is
+    "none". If it is "fail", the test is run without waves, then run
+    again with waves only if it failed or the simulator timed out. See
+    rerun_with_waves.
+
+    If the test has an input digest, its result is taken from the result
+    cache when possible, unless force is set. Waves and retire traces are
+    not cached, so are only shown with a cached result if they were
+    written by a run with the same digest. A cached failure without its
+    waves is re-run with waves if they are wanted, and a test whose
+    retire trace is wanted but missing is not taken from the cache. See
+    run_sim for server.
+    """
+    if(not force and
+       (test.trace_file is None or test.artefact_current(test.trace_file))
+       and test.load_cached()):
+        if(not test.artefact_current(test.vcd_file)):
+            test.remove_artefacts([test.vcd_file])
+            if(waves != "none" and test.result == "FAILED"):
+                rerun_with_waves(test, simulator, timeout, server)
+                test.mark_artefacts()
+        return test
+
+    start = time.time()
 
-        cmd = ["make", "run-vl",
-                "TEST_HEX=%s"   % test.hex_file,
-                "HALT_ADDR=%s"  % test.halt_addr,
-                "PASS_ADDR=%s"  % test.pass_addr,
-                "FAIL_ADDR=%s"  % test.fail_addr,
-                "COV_DB=%s"     % test.cov_db]
+    # A test which errors may not write a coverage database, waves or a
+    # retire trace, so those left by an earlier run must not be mistaken
+    # for this run's.
+    test.remove_artefacts()
+    if(os.path.isfile(test.cov_db)):
+        os.remove(test.cov_db)
+
+    run_sim(test, simulator, timeout, waves = (waves == "all"),
+            server = server)
+
+    test.runtime = time.time() - start
+
+    if(waves == "fail" and test.result in ["FAILED", "TIMEOUT"] and
+       not test.killed):
+        rerun_with_waves(test, simulator, timeout, server)
+
+    test.mark_artefacts()
+    test.save_cached()
+
+    return test
+
+def rerun_with_waves(test, simulator = SIMULATOR, timeout = None,
+                     server = False):
+    """
+    Run a failed test again with waves on. Tests which reached their
+    cycle limit are re-run too, keeping only the last TIMEOUT_WAVE_RING
+    to twice that many cycles of waves, as these are usually a hung core.
+    Tests killed for running too long in wall clock time are not, as the
+    re-run would just be killed again, and nor are errors. The result and
+    timing of the first run are kept, so that the recorded times are
+    those of a run without waves.
+    """
+    first = test.record()
+
+    run_sim(test, simulator, timeout, waves = True, server = server,
+            wave_ring = TIMEOUT_WAVE_RING if test.result == "TIMEOUT"
+                        else None)
+
+    test.restore_result(first["result"])
+    test.returncode  = first["exit_status"]
+    test.killed      = first["killed"]
+    test.sim_runtime = first["sim_wall_time"]
+    test.cycles      = first["cycles"]
+
+def start_watchdog(proc, timeout):
+    """
+    Kill proc if it is still running after "timeout" seconds. Returns the
+    watchdog timer (or None if there is no timeout), and a list which
+    becomes non-empty if the process is killed.
+    """
+    killed = []
+
+    def kill():
+        killed.append(True)
+        proc.kill()
+
+    timer = None
+    if(timeout):
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+
+    return timer, killed
+
+def read_result(stream, log, end_marker = None):
+    """
+    Read simulator output from stream into log as it is produced, and
+    return the result given by the first result marker seen, or None.
+    Reading stops at end_marker if given, otherwise just after the first
+    result marker, since nothing of interest is printed after one.
+    """
+    result = None
+
+    for line in iter(stream.readline, ""):
+        log.append(line)
+        if(result is None):
+            for marker, marker_result in RESULT_MARKERS:
+                if(line.startswith(marker)):
+                    result = marker_result
+                    break
+        if(end_marker is None and result is not None):
+            break
+        elif(end_marker is not None and line.startswith(end_marker)):
+            break
+
+    return result
+
+class SimulatorServer(object):
+    """
+    A simulator running in batch mode (+BATCH), which runs tests sent to
+    it one at a time on the same model, so that each test does not pay
+    for starting the process and building the model.
+    """
+
+    def __init__(self, simulator = SIMULATOR):
+        self.simulator  = simulator
+        self.proc       = None
+
+    def job(self, test, waves = True):
+        """
+        Return the fields of the job line which runs a test on the server.
+        """
+        job = test.sim_command(self.simulator, waves = waves)[1:6]
+        job.append(str(test.max_cycles or 0))
+        job.append(os.path.abspath(test.trace_file) if test.trace_file
+                   else "-")
+        return job
+
+    def accepts(self, test, waves = True):
+        """
+        Return True if the test can be sent to the server. The fields of a
+        job line are separated by whitespace, so none may contain any.
+        """
+        return all(len(field.split()) == 1 for field in self.job(test, waves))
+
+    def run(self, test, timeout = None, waves = True):
+        """
+        Run a test on the server, starting the server first if need be.
+        Output is added to the test's log. Returns the result given by
+        the first result marker seen (or None), whether the server had
+        to be killed for taking longer than "timeout" seconds, and an
+        exit status: 0 if the job finished, otherwise that of the server.
+        """
+        if(self.proc is None or self.proc.poll() is not None):
+            self.proc = subprocess.Popen([self.simulator, "+BATCH"],
+                                         stdin  = subprocess.PIPE,
+                                         stdout = subprocess.PIPE,
+                                         stderr = subprocess.STDOUT,
+                                         universal_newlines = True)
+
+        job = self.job(test, waves)
+
+        timer, killed = start_watchdog(self.proc, timeout)
+
+        self.proc.stdin.write(" ".join(job) + "\n")
+        self.proc.stdin.flush()
+
+        result = read_result(self.proc.stdout, test.log, end_marker="JOB END")
+
+        if(timer):
+            timer.cancel()
+
+        # A killed or crashed server is started again by the next job.
+        returncode = 0
+        if(killed or result is None):
+            returncode = self.stop()
+
+        return result, bool(killed), returncode
+
+    def stop(self):
+        """
+        Stop the server, if it is running, and return its exit status.
+        """
+        returncode = None
+        if(self.proc is not None):
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                pass
+            if(self.proc.poll() is None):
+                self.proc.kill()
+            returncode = self.proc.wait()
+            self.proc  = None
+        return returncode
+
+#: Simulator servers owned by this process, keyed by simulator path.
+SERVERS = {}
+
+def get_server(simulator):
+    """
+    Return this process's SimulatorServer for the given simulator.
+    """
+    if(simulator not in SERVERS):
+        SERVERS[simulator] = SimulatorServer(simulator)
+    return SERVERS[simulator]
+
+def parse_cycles(output):
+    """
+    Return the number of cycles the simulator reports it simulated in
+    its output, or None if it does not say.
+    """
+    index = output.rfind(CYCLES_MARKER)
+    if(index < 0):
+        return None
+    try:
+        return int(output[index + len(CYCLES_MARKER):].split(None, 1)[0])
+    except (ValueError, IndexError):
+        return None
+
+def run_sim(test, simulator = SIMULATOR, timeout = None, waves = True,
+            server = False, wave_ring = None):
+    """
+    Run the simulator once for a RegressionTest and record the result.
+    If server is set, the test is run on this process's simulator server
+    rather than by starting the simulator just for this test, unless it
+    has whitespace in one of its paths or a wave_ring is given, which the
+    server only takes for all of its jobs. See RegressionTest.sim_command.
+
+    The simulator is killed, and the test marked as timed out and killed,
+    if it runs for more than "timeout" seconds of wall clock time.
+    """
+    test.log = SimulatorLog()
+    start    = time.time()
+
+    # Tests with whitespace in their paths can not be sent to a server as
+    # a job line, and a server keeps the same waves options for every job,
+    # so such runs start the simulator as usual.
+    if(server and not wave_ring and
+       get_server(simulator).accepts(test, waves)):
+        result, killed, returncode = get_server(simulator).run(test,
+                                                               timeout, waves)
+
+    else:
+        cmd = test.sim_command(simulator, waves = waves,
+                               wave_ring = wave_ring)
         try:
-            output = subprocess.check_output(cmd)
+            proc = subprocess.Popen(cmd,
+                                    stdout = subprocess.PIPE,
+                                    stderr = subprocess.STDOUT,
+                                    universal_newlines = True)
+        except OSError as e:
+            test.errored(e)
+            return
+
+        timer, killed = start_watchdog(proc, timeout)
+
+        result = read_result(proc.stdout, test.log)
 
-            if("TEST PASS" in output):
-                test.passed(output)
-            elif("TEST FAIL" in output):
-                test.failed(output)
+        proc.stdout.close()
+        proc.wait()
+
+        if(timer):
+            timer.cancel()
+
+        returncode = proc.returncode
+
+    output   = str(test.log)
+    test.log = None
+
+    test.sim_runtime = time.time() - start
+    test.returncode  = returncode
+    test.cycles      = parse_cycles(output)
+    test.killed      = bool(killed)
+
+    if(killed or result == "TIMEOUT"):
+        test.timedout(output)
+    elif(result == "PASSED" and returncode == 0):
+        test.passed(output)
+    elif(result == "FAILED"):
+        test.failed(output)
+    else:
+        test.errored(returncode)
+
+    with open(test.log_file, "w") as fh:
+        fh.write(output)
+
+def merge_coverage(tool, out_file, in_files):
+    """
+    Merge coverage databases into out_file with verilator_coverage.
+    Returns out_file, or None if the merge failed.
+    """
+    cmd = [tool, "--write", out_file] + list(in_files)
+    try:
+        with open(os.devnull, "w") as null:
+            subprocess.check_call(cmd, stdout = null)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print("%sCoverage merge failed: %s%s" % (RED, e, RESET))
+        return None
+    return out_file
+
+class CoverageMerger(object):
+    """
+    Merges the coverage databases of tests as they finish, so the merged
+    database is ready soon after the last test.
+
+    Databases are merged in pairs, as a tree: two databases which each
+    hold the coverage of 2^k tests are merged into one holding 2^(k+1).
+    Each merge only ever reads two databases, so its cost does not grow
+    with the number of tests, and when the last test finishes there are
+    at most log2(tests) databases left to combine. Merges run on a pool
+    of "jobs" threads, each running verilator_coverage.
+
+    If any merge fails, the coverage it would have combined is lost, so
+    no final database is written.
+    """
+
+    def __init__(self, out_file, jobs = 1, tool = COVERAGE_TOOL):
+        """
+        Start a merger which writes the final database to out_file.
+        """
+        self.out_file   = out_file
+        self.tool       = tool
+        self.pool       = multiprocessing.pool.ThreadPool(max(1, jobs))
+        self.events     = queue.Queue()
+        self.merges     = 0
+        self.failed     = False
+        self.result     = None
+        self.thread     = threading.Thread(target = self.__run__)
+        self.thread.daemon = True
+
+        if(not os.path.isdir(COV_MERGE_DIR)):
+            os.makedirs(COV_MERGE_DIR)
+
+        self.thread.start()
+
+    def add(self, cov_file):
+        """
+        Add the coverage database of a finished test.
+        """
+        self.events.put((0, cov_file))
+
+    def finish(self):
+        """
+        Wait for all merges to finish and write the final database.
+        Returns the path of the final database, or None if there is none
+        or a merge failed.
+        """
+        self.events.put(None)
+        self.thread.join()
+        self.pool.close()
+        self.pool.join()
+        return self.result
+
+    def __temporary__(self, path):
+        """
+        Return True if path is a partial merge made by this merger.
+        """
+        return path is not None and \
+               os.path.dirname(path) == COV_MERGE_DIR
+
+    def __merge_task__(self, level, out_file, in_files):
+        """
+        Run in the pool to merge in_files into out_file. Always reports
+        back to __run__, with an out_file of None if the merge failed.
+        Partial merges are kept if the merge failed, to help find out why.
+        """
+        merged = None
+        try:
+            merged = merge_coverage(self.tool, out_file, in_files)
+            for path in in_files:
+                if(merged and self.__temporary__(path)):
+                    os.remove(path)
+        except Exception as e:
+            print("%sCoverage merge failed: %s%s" % (RED, e, RESET))
+            merged = None
+        finally:
+            self.events.put((level, merged, True))
+
+    def __merge__(self, level, in_files):
+        """
+        Start merging in_files in the pool, giving a database at level.
+        """
+        self.merges += 1
+        out_file = os.path.join(COV_MERGE_DIR,
+                                "merge-%d-%d.cov" % (os.getpid(), self.merges))
+        self.pool.apply_async(self.__merge_task__,
+                              (level, out_file, in_files))
+
+    def __run__(self):
+        """
+        Pair up databases of equal level as they arrive, until finish is
+        called and every merge is done, then write the final database.
+        """
+        levels   = {}
+        pending  = 0
+        finished = False
+
+        while(not finished or pending):
+            event = self.events.get()
+            if(event is None):
+                finished = True
+                continue
+
+            level, path = event[0], event[1]
+            if(len(event) > 2):
+                pending -= 1
+
+            if(path is None):
+                self.failed = True
+            elif(self.failed):
+                continue
+            elif(level in levels):
+                self.__merge__(level + 1, [levels.pop(level), path])
+                pending += 1
             else:
-                test.failed(output)
-            vcd_name = os.path.basename(test.hex_file).split(".")[0]+".vcd"
-            shutil.copyfile(os.path.join("work","waves.vcd"),
-                            os.path.join(vcd_dir, vcd_name))
-        
-        except subprocess.CalledProcessError as e:
-            test.errored(e)
+                levels[level] = path
 
-        i += 1
+        remaining = [levels[level] for level in sorted(levels)]
+
+        if(self.failed or not remaining):
+            self.result = None
+        elif(len(remaining) == 1 and not self.__temporary__(remaining[0])):
+            shutil.copyfile(remaining[0], self.out_file)
+            self.result = self.out_file
+        elif(len(remaining) == 1):
+            shutil.move(remaining[0], self.out_file)
+            self.result = self.out_file
+        else:
+            self.result = merge_coverage(self.tool, self.out_file, remaining)
+            for path in remaining:
+                if(self.result and self.__temporary__(path)):
+                    os.remove(path)
+
+def run_regressions(to_run, jobs = 1, simulator = SIMULATOR,
+                    timeout = None, max_cycles = None, waves = "fail",
+                    cache = True, force = False, server = False,
+                    results_file = None, times_file = TIMES_FILE,
+                    junit_file = None, history_file = HISTORY_FILE,
+                    cov_merged = None, retire_trace = False):
+    """
+    Takes a list of RegressionTest objects and runs them, using up to
+    "jobs" tests at once. Results are printed in the order of to_run.
+    Tests without their own cycle limit use max_cycles, if given. See
+    run_test for the meaning of waves, force and server.
+
+    The results are also written to results_file as JSON and junit_file
+    as JUnit XML if given. The runtime of each test is recorded in
+    times_file, and the throughput of the run appended to history_file,
+    if given. If cov_merged is given, the coverage databases of the tests
+    are merged into it as they finish. If retire_trace is set, each test
+    writes a retire trace into RETIRE_TRACE_DIR.
+
+    If cache is set, each test is given a digest of its inputs so that
+    its result can be re-used until the simulator or test changes.
+    """
+    
+    for path in [os.path.join("work","vcd"),
+                 os.path.join("work","cov-db"),
+                 os.path.join("work","logs"),
+                 RETIRE_TRACE_DIR if retire_trace else None,
+                 os.path.dirname(results_file or ""),
+                 os.path.dirname(junit_file or ""),
+                 CACHE_DIR]:
+        if(path and not os.path.isdir(path)):
+            os.makedirs(path)
+
+    sim_digest = None
+    if(cache and os.path.isfile(simulator)):
+        sim_digest = file_digest(simulator)
+
+    for test in to_run:
+        if(not test.max_cycles):
+            test.max_cycles = max_cycles
+        if(retire_trace):
+            test.trace_file = os.path.join(RETIRE_TRACE_DIR,
+                                           test.name+".trace")
+        if(sim_digest and os.path.isfile(test.image_file)):
+            test.digest = test.input_digest(sim_digest)
+
+    run = functools.partial(run_test, simulator = simulator,
+                                      timeout   = timeout,
+                                      waves     = waves,
+                                      force     = force,
+                                      server    = server)
+
+    print("RESULT  | PASS       | FAIL       | HALT       | TEST")
+    print("--------|------------|------------|------------|--------------------")
+
+    if(jobs > 1):
+        pool    = multiprocessing.Pool(jobs)
+        results = pool.imap(run, to_run)
+    else:
+        pool    = None
+        results = (run(test) for test in to_run)
+
+    merger = CoverageMerger(cov_merged, jobs) if cov_merged else None
+
+    ran = []
+    for test in results:
         print(str(test))
+        ran.append(test)
+        if(merger and test.result in ["PASSED", "FAILED"] and
+           os.path.isfile(test.cov_db)):
+            merger.add(test.cov_db)
+
+    if(pool):
+        pool.close()
+        pool.join()
+
+    for sim_server in SERVERS.values():
+        sim_server.stop()
+
+    if(merger and merger.finish()):
+        print("Merged coverage written to %s" % cov_merged)
+    elif(merger and merger.failed):
+        print("%sCoverage merge failed, %s not written%s" % (RED, cov_merged,
+                                                           RESET))
+
+    if(results_file):
+        write_results(ran, results_file)
+
+    if(junit_file):
+        write_junit(ran, junit_file)
+
+    if(times_file):
+        save_times(ran, times_file)
+
+    if(history_file):
+        append_history(ran, history_file)
+
+def parseargs():
+    """
+    Parses and returns all command line arguments to the program.
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("regression_list", type=str,
+        help="CSV file listing the tests to run.")
+    parser.add_argument("-j","--jobs", type=int, default=1,
+        help="Number of tests to run in parallel.")
+    parser.add_argument("--sim", type=str, default=SIMULATOR,
+        help="Path to the verilated simulation executable.")
+    parser.add_argument("-t","--timeout", type=float, default=None,
+        help="Wall clock time limit for each test, in seconds.")
+    parser.add_argument("-c","--max-cycles", type=int, default=None,
+        help="Default simulated clock cycle limit for each test.")
+    parser.add_argument("-w","--waves", choices=WAVE_MODES, default="fail",
+        help="Dump waves for all tests, none, or only re-run failing "+
+             "tests with waves on.")
+    parser.add_argument("-f","--force", action="store_true",
+        help="Re-run every test, even if it has a cached result.")
+    parser.add_argument("--no-cache", action="store_true",
+        help="Neither use nor update the cache of test results.")
+    parser.add_argument("-s","--server", action="store_true",
+        help="Run tests on long lived batch mode simulators, one per job, "+
+             "rather than starting the simulator for every test.")
+    parser.add_argument("--shard", type=str, default=None, metavar="I/N",
+        help="Split the tests into N shards of about equal runtime and "+
+             "only run shard I, counting from 1. Hosts must share the "+
+             "same --times file to agree on the split.")
+    parser.add_argument("--times", type=str, default=TIMES_FILE,
+        help="JSON file of test runtimes used to balance shards. Updated "+
+             "by unsharded runs and by --merge, but not by shards.")
+    parser.add_argument("-o","--results", type=str, default=None,
+        help="JSON file to write the result, exit status, wall time and "+
+             "simulated cycles of each test to. Defaults to "+
+             os.path.join(RESULTS_DIR,"shard-I-of-N.json")+" for shards.")
+    parser.add_argument("--junit", type=str, default=None,
+        help="JUnit XML file to write results to.")
+    parser.add_argument("--history", type=str, default=HISTORY_FILE,
+        help="File to append the simulation throughput of each run to. "+
+             "Shards do not write it, --merge does.")
+    parser.add_argument("-m","--merge-cov", type=str, default=None,
+        metavar="COV_DB",
+        help="Merge the coverage of the tests into this database as they "+
+             "finish, using $RVM_VERILATOR_COV.")
+    parser.add_argument("--merge", type=str, nargs="+", default=None,
+        metavar="RESULTS",
+        help="Print the merged results of shards, written with --results, "+
+             "instead of running tests.")
+    parser.add_argument("--retire-trace", action="store_true",
+        help="Write a trace of the instructions each test retires to "+
+             os.path.join(RETIRE_TRACE_DIR,"<test>.trace")+".")
+
+    args = parser.parse_args()
+
+    if(args.shard):
+        try:
+            args.shard = tuple(int(n) for n in args.shard.split("/"))
+            index, count = args.shard
+        except ValueError:
+            parser.error("--shard must be of the form I/N")
+        if(not 1 <= index <= count):
+            parser.error("--shard index must be between 1 and %d" % count)
+
+    if(args.shard and not args.results):
+        args.results = os.path.join(RESULTS_DIR,
+                                    "shard-%d-of-%d.json" % args.shard)
+
+    return args
 
 def main():
     """
     Main function for the program
     """
 
-    rdb = load_db(sys.argv[1])
+    args = parseargs()
+
+    rdb = load_db(args.regression_list)
+
+    if(args.merge):
+        merge_results(rdb, args.merge, times_file = args.times,
+                                       junit_file = args.junit,
+                                       history_file = args.history)
+        return
+
+    if(args.shard):
+        rdb = shard_tests(rdb, args.shard[0], args.shard[1],
+                          load_times(args.times))
     
-    run_regressions(rdb)
+    run_regressions(rdb, jobs       = args.jobs,
+                         simulator  = args.sim,
+                         timeout    = args.timeout,
+                         max_cycles = args.max_cycles,
+                         waves      = args.waves,
+                         cache      = not args.no_cache,
+                         force      = args.force,
+                         server     = args.server,
+                         results_file = args.results,
+                         times_file = None if args.shard else args.times,
+                         junit_file = args.junit,
+                         history_file = None if args.shard else args.history,
+                         cov_merged = args.merge_cov,
+                         retire_trace = args.retire_trace)
 
 
 if(__name__ == "__main__"):
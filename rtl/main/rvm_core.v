@@ -23,6 +23,18 @@ output wire [ 3:0]  mem_b_en,           // Memory byte enable
 input  wire         mem_error,          // Memory error indicator
 input  wire         mem_stall           // Memory stall indicator
 
+`ifdef RVM_RETIRE_TRACE
+/*verilator coverage_off*/
+,
+output reg          trs_valid   ,       // An instruction retired.
+output reg  [31:0]  trs_pc      ,       // PC of the retired instruction.
+output reg  [31:0]  trs_instr   ,       // Encoding of the instruction.
+output reg          trs_rd_wen  ,       // It wrote a register.
+output reg  [ 4:0]  trs_rd_addr ,       // Register it wrote.
+output reg  [31:0]  trs_rd_wdata        // Value it wrote.
+/*verilator coverage_on*/
+`endif
+
 );
 
 //-----------------------------------------------------------------------------
@@ -252,5 +264,61 @@ rvm_scu i_scu(
 .mtvec              (s_mtvec)  // The machine trap handler address register.
 );
 
+`ifdef RVM_RETIRE_TRACE
+//-----------------------------------------------------------------------------
+// Instruction retire trace, for simulation only. An instruction retires
+// when the fetch of the next instruction completes. The trs_* outputs then
+// hold its PC, its encoding and any register write it made, with trs_valid
+// set for that one cycle. None of it is part of the design, so it is
+// kept out of the coverage figures.
+//
+
+/*verilator coverage_off*/
+
+reg  [31:0] trs_cur_pc    ; // PC of the instruction being executed.
+reg  [31:0] trs_cur_instr ; // Encoding of the instruction being executed.
+reg         trs_cur_live  ; // An instruction has been fetched.
+reg         trs_cur_wen   ; // It has written a register.
+reg  [ 4:0] trs_cur_addr  ; // Register it wrote.
+reg  [31:0] trs_cur_wdata ; // Value it wrote.
+
+wire        trs_fetched   = scu_instr_retired && !mem_stall;
+
+always @(posedge clk, negedge resetn) begin : p_retire_trace
+    if(!resetn) begin
+        trs_valid     <= 1'b0;
+        trs_pc        <= 32'b0;
+        trs_instr     <= 32'b0;
+        trs_rd_wen    <= 1'b0;
+        trs_rd_addr   <= 5'b0;
+        trs_rd_wdata  <= 32'b0;
+        trs_cur_pc    <= 32'b0;
+        trs_cur_instr <= 32'b0;
+        trs_cur_live  <= 1'b0;
+        trs_cur_wen   <= 1'b0;
+        trs_cur_addr  <= 5'b0;
+        trs_cur_wdata <= 32'b0;
+    end else begin
+        trs_valid     <= trs_fetched && trs_cur_live;
+        if(trs_fetched) begin
+            trs_pc        <= trs_cur_pc;
+            trs_instr     <= trs_cur_instr;
+            trs_rd_wen    <= trs_cur_wen;
+            trs_rd_addr   <= trs_cur_addr;
+            trs_rd_wdata  <= trs_cur_wdata;
+            trs_cur_pc    <= s_pc;
+            trs_cur_instr <= mem_rdata;
+            trs_cur_live  <= 1'b1;
+            trs_cur_wen   <= 1'b0;
+        end else if(d_rd_wen && d_rd_addr != 5'b0) begin
+            trs_cur_wen   <= 1'b1;
+            trs_cur_addr  <= d_rd_addr;
+            trs_cur_wdata <= d_rd_wdata;
+        end
+    end
+end
+/*verilator coverage_on*/
+`endif
+
 endmodule
 
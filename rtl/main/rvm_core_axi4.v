@@ -40,6 +40,18 @@ input             M_AXI_WREADY,     //
 output     [ 3:0] M_AXI_WSTRB,      // 
 output            M_AXI_WVALID      // 
 
+`ifdef RVM_RETIRE_TRACE
+/*verilator coverage_off*/
+,
+output            trs_valid   ,     // An instruction retired.
+output     [31:0] trs_pc      ,     // PC of the retired instruction.
+output     [31:0] trs_instr   ,     // Encoding of the instruction.
+output            trs_rd_wen  ,     // It wrote a register.
+output     [ 4:0] trs_rd_addr ,     // Register it wrote.
+output     [31:0] trs_rd_wdata      // Value it wrote.
+/*verilator coverage_on*/
+`endif
+
 );
 
 wire [31:0]  mem_addr;          // Memory address lines
@@ -162,6 +174,15 @@ rvm_core i_rvm_core(
 .mem_b_en    (mem_b_en ), // Memory byte enable
 .mem_error   (mem_error), // Memory error indicator
 .mem_stall   (mem_stall)  // Memory stall indicator
+`ifdef RVM_RETIRE_TRACE
+,
+.trs_valid   (trs_valid   ), // An instruction retired.
+.trs_pc      (trs_pc      ), // PC of the retired instruction.
+.trs_instr   (trs_instr   ), // Encoding of the instruction.
+.trs_rd_wen  (trs_rd_wen  ), // It wrote a register.
+.trs_rd_addr (trs_rd_addr ), // Register it wrote.
+.trs_rd_wdata(trs_rd_wdata)  // Value it wrote.
+`endif
 );
 
 endmodule
@@ -32,6 +32,21 @@ class axi_device {
         */
         virtual void store(vluint32_t address, vluint32_t data) = 0;
 
+        /*!
+        @brief Store the bytes of a word selected by an AXI write strobe.
+        @param in address - The address to store the data at. Expected to be
+            word aligned. I.e. the low two bits are zero.
+        @param in data - The data to store.
+        @param in strobe - Bit N set means byte N of data is written.
+        @details Devices which can update part of a word in place should
+            override this. By default the word is loaded, merged and stored.
+        */
+        virtual void store(vluint32_t address, vluint32_t data,
+                           vluint8_t strobe) {
+            vluint32_t mask = strobe_mask(strobe);
+            this -> store(address, (data & mask) | (load(address) & ~mask));
+        }
+
         /*!
         @brief Instance a new AXI device with the given address range.
         */
@@ -51,6 +66,18 @@ class axi_device {
 
     protected:
 
+        /*!
+        @brief Turn an AXI write strobe into a mask of the bits it selects.
+        @param in strobe - Bit N set means byte N is selected.
+        @returns A word with every bit of each selected byte set.
+        */
+        static vluint32_t strobe_mask(vluint8_t strobe) {
+            return ((strobe & 0x8 ? 0xFF : 0x00) << 24) |
+                   ((strobe & 0x4 ? 0xFF : 0x00) << 16) |
+                   ((strobe & 0x2 ? 0xFF : 0x00) <<  8) |
+                   ((strobe & 0x1 ? 0xFF : 0x00) <<  0) ;
+        }
+
         //! Top address for this device.
         vluint32_t  device_addr_hi;
 
@@ -1,4 +1,6 @@
 
+#include <algorithm>
+#include <cstring>
 #include <iostream>
 
 #include "axi_memory.h"
@@ -10,10 +12,30 @@
 axi_memory::axi_memory ( vluint32_t hi_addr, 
                          vluint32_t lo_addr,
                          vluint32_t default_value)
-: axi_device(hi_addr, lo_addr){
+: axi_device(hi_addr, lo_addr),
+  pages(((hi_addr - lo_addr) >> page_bits) + 1, nullptr) {
     this -> default_return_value = default_value;
 }
 
+
+/*!
+@brief Free all of the pages of the device.
+*/
+axi_memory::~axi_memory() {
+    this -> clear();
+}
+
+
+/*!
+@brief Free all memory, so every address reads as zero again.
+*/
+void axi_memory::clear() {
+    for(size_t i = 0; i < pages.size(); i ++) {
+        delete [] pages[i];
+        pages[i] = nullptr;
+    }
+}
+
         
 /*!
 @brief Loads a single word from the AXI device.
@@ -23,9 +45,11 @@ axi_memory::axi_memory ( vluint32_t hi_addr,
 */
 vluint32_t axi_memory::load(vluint32_t address) {
     if(address_hit(address)) {
-        return mem[address & 0xFFFFFFFC];
+        vluint32_t * page = page_for(address, false);
+        return page ? page[word_index(address)] : 0;
     } else {
         std::cerr << "ERROR: address "<<address<< " is not in the mapped range of this device: <" << this->device_addr_lo <<","<<this->device_addr_hi<<">"<<std::endl;
+        return this -> default_return_value;
     }
 }
 
@@ -39,8 +63,61 @@ vluint32_t axi_memory::load(vluint32_t address) {
 */
 void axi_memory::store(vluint32_t address, vluint32_t data) {
     if(address_hit(address)) {
-        mem[address & 0xFFFFFFFC] = data;
+        page_for(address, true)[word_index(address)] = data;
+    } else {
+        std::cerr << "ERROR: address "<<address<< " is not in the mapped range of this device: <" << this->device_addr_lo <<","<<this->device_addr_hi<<">"<<std::endl;
+    }
+}
+
+
+/*!
+@brief Store the bytes of a word selected by an AXI write strobe.
+@param in address - The address to store the data at. Expected to be
+    word aligned. I.e. the low two bits are zero.
+@param in data - The data to store.
+@param in strobe - Bit N set means byte N of data is written.
+@returns void
+*/
+void axi_memory::store(vluint32_t address, vluint32_t data,
+                       vluint8_t strobe) {
+    if(address_hit(address)) {
+        vluint32_t   mask = strobe_mask(strobe);
+        vluint32_t & word = page_for(address, true)[word_index(address)];
+        word = (data & mask) | (word & ~mask);
     } else {
         std::cerr << "ERROR: address "<<address<< " is not in the mapped range of this device: <" << this->device_addr_lo <<","<<this->device_addr_hi<<">"<<std::endl;
     }
 }
+
+
+/*!
+@brief Copy a block of words into memory, starting at address.
+@returns The number of words copied.
+*/
+size_t axi_memory::preload(vluint32_t address, const vluint32_t * words,
+                           size_t count) {
+    size_t copied = 0;
+
+    while(copied < count && address_hit(address)) {
+        
+        // Copy up to the end of the page holding address, or the end of
+        // the device if that comes first.
+        size_t index = word_index(address);
+        size_t chunk = std::min<size_t>(page_words - index, count - copied);
+        chunk = std::min<size_t>(chunk,
+                                 ((device_addr_hi - address) >> 2) + 1);
+
+        std::memcpy(page_for(address, true) + index, words + copied,
+                    chunk * sizeof(vluint32_t));
+
+        copied  += chunk;
+        address += chunk * 4;
+
+        // Stop if the address wrapped around the top of the address space.
+        if(address == 0) {
+            break;
+        }
+    }
+
+    return copied;
+}
@@ -1,5 +1,6 @@
 
-#include <map>
+#include <cstddef>
+#include <vector>
 
 #include "verilated.h"
 
@@ -16,7 +17,7 @@ class axi_memory : public axi_device {
         @brief Loads a single word from the AXI memory device.
         @param in address - The address of the data to return. Expected to be
             word aligned. I.e. the low two bits are zero.
-        @returns the data at that address.
+        @returns the data at that address, or zero if it was never written.
         */
         virtual vluint32_t load(vluint32_t address);
         
@@ -29,6 +30,30 @@ class axi_memory : public axi_device {
         */
         virtual void store(vluint32_t address, vluint32_t data);
 
+        /*!
+        @brief Store the bytes of a word selected by an AXI write strobe.
+        @param in address - The address to store the data at. Expected to be
+            word aligned. I.e. the low two bits are zero.
+        @param in data - The data to store.
+        @param in strobe - Bit N set means byte N of data is written.
+        @returns void
+        */
+        virtual void store(vluint32_t address, vluint32_t data,
+                           vluint8_t strobe);
+
+        /*!
+        @brief Copy a block of words into memory, starting at address.
+        @details Whole pages are copied at once, rather than one word at a
+            time. Words which fall outside the device are ignored.
+        @returns The number of words copied.
+        */
+        size_t preload(vluint32_t address, const vluint32_t * words,
+                       size_t count);
+
+        /*!
+        @brief Free all memory, so every address reads as zero again.
+        */
+        void clear();
         
         /*!
         @brief Instance a new AXI memory device.
@@ -37,15 +62,44 @@ class axi_memory : public axi_device {
         axi_memory( vluint32_t hi_addr, 
                     vluint32_t lo_addr, 
                     vluint32_t default_value);
+
+        ~axi_memory();
     
     private:
 
-        //! The internal associative memory array for the device.
-    	std::map<vluint32_t, vluint32_t> mem;
+        //! Each page holds 1 << page_bits bytes of memory.
+        static const unsigned page_bits  = 12;
+
+        //! Number of words in each page.
+        static const vluint32_t page_words = (1 << page_bits) / 4;
+
+        //! One pointer per page of the device's address range. Pages are
+        //! only allocated when written to, and read as zero until then.
+        std::vector<vluint32_t*> pages;
         
-        //! The default value returned when we hit uninitialised memory.
+        //! The default value returned for addresses outside the device.
         vluint32_t  default_return_value;
 
+        /*!
+        @brief Return the page holding address, allocating it if it does
+            not exist yet and allocate is set, otherwise returning nullptr.
+        */
+        vluint32_t * page_for(vluint32_t address, bool allocate) {
+            vluint32_t * & page = pages[(address - device_addr_lo)
+                                        >> page_bits];
+            if(page == nullptr && allocate) {
+                page = new vluint32_t[page_words]();
+            }
+            return page;
+        }
+
+        /*!
+        @brief Return the index of the word holding address in its page.
+        */
+        static vluint32_t word_index(vluint32_t address) {
+            return (address >> 2) & (page_words - 1);
+        }
+
 };
 
 #endif
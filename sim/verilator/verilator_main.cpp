@@ -1,53 +1,213 @@
 
 #include <iostream>
 #include <cstdio>
+#include <cstring>
+#include <sstream>
+#include <string>
+#include <vector>
 
 #include "Vrvm_core_axi4.h"
 #include "verilated.h"
 
 #include "verilator_sim.hpp"
 
+/*!
+@brief Return the value of a "+NAME=value" plusarg, or nullptr if it was
+       not given on the command line.
+@param in name - The plusarg name, including the trailing '='.
+*/
+static const char * plusarg_value(const char * name) {
+    const char * match = Verilated::commandArgsPlusMatch(name);
+    if(match && match[0] == '+') {
+        return match + 1 + strlen(name);
+    } else {
+        return nullptr;
+    }
+}
+
+/*!
+@brief Configure the simulation to run a single test.
+@param in waves_file - Where to dump waves to, or "-" for no waves.
+@param in mem_file - The hex, binary (.bin) or ELF file to load into
+    main memory.
+@param in pass_addr - Hex string of the address which passes the test.
+@param in fail_addr - Hex string of the address which fails the test.
+@param in cov_file - Where to write coverage data to.
+@param in trace_file - Where to write the retire trace to, or "-" or
+    nullptr for no retire trace.
+*/
+static void setup_test(verilator_sim * sim,
+                       const char    * waves_file,
+                       const char    * mem_file,
+                       const char    * pass_addr,
+                       const char    * fail_addr,
+                       const char    * cov_file,
+                       const char    * trace_file) {
+
+    vluint32_t pass = std::stoul(pass_addr,nullptr,16);
+    vluint32_t fail = std::stoul(fail_addr,nullptr,16);
+
+    std::cout << "Pass address: " << pass << " " << pass_addr << std::endl;
+    std::cout << "Fail address: " << fail << " " << fail_addr << std::endl;
+
+    // A waves file of "-" turns wave dumping off.
+    if(strcmp(waves_file, "-") != 0) {
+        sim -> dump_waves_to(waves_file);
+    }
+    if(trace_file && strcmp(trace_file, "-") != 0) {
+        sim -> trace_retire_to(trace_file);
+    }
+    sim -> dump_coverage_to(cov_file);
+    sim -> set_pass_fail_addrs(pass, fail);
+    sim -> preload_main_memory(mem_file, 0x80000000);
+}
+
+
+/*!
+@brief Configure when waves are dumped from the wave plusargs, which apply
+       to every test run by this process:
+    +WAVE_START=<cycle>  +WAVE_END=<cycle>  - Only dump inside this window.
+    +WAVE_TRIGGER_ADDR=<hex addr>           - Start dumping once the address
+                                              is seen on the AXI bus.
+    +WAVE_RING=<cycles>                     - Keep two rotating segments of
+                                              this many cycles, the earlier
+                                              in "<waves file>.prev".
+*/
+static void setup_waves(verilator_sim * sim) {
+
+    const char * wave_start   = plusarg_value("WAVE_START=");
+    const char * wave_end     = plusarg_value("WAVE_END=");
+    const char * wave_trigger = plusarg_value("WAVE_TRIGGER_ADDR=");
+    const char * wave_ring    = plusarg_value("WAVE_RING=");
+
+    if(wave_start || wave_end) {
+        sim -> set_wave_window(wave_start ? std::stoull(wave_start) : 0,
+                               wave_end   ? std::stoull(wave_end)   : 0);
+    }
+    if(wave_trigger) {
+        sim -> set_wave_trigger(std::stoul(wave_trigger,nullptr,16));
+    }
+    if(wave_ring) {
+        sim -> set_wave_ring(std::stoull(wave_ring));
+    }
+}
+
+
+/*!
+@brief Print the result of a test in the form expected by regression.py
+*/
+static void report_result(bool result) {
+    
+    std::cout << "Finished with code " << result << std::endl;
+    
+    if(result) {
+        std::cout << "TEST PASS" << std::endl;
+    } else {
+        std::cout << "TEST FAIL" << std::endl;
+    }
+}
+
+
+/*!
+@brief Run tests read from stdin, one per line, re-using the same DUT.
+@details Each line has the form:
+    <waves file|-> <memory file> <pass addr> <fail addr> <cov file>
+        [cycles [retire trace file|-]]
+    Fields are separated by whitespace, so no path may contain any. The
+    simulation is reset between tests, see verilator_sim::reset. The end of
+    each test's output is marked with a "JOB END" line. Returns when stdin
+    is closed.
+*/
+static void run_batch(verilator_sim * sim) {
+
+    std::string line;
+
+    while(std::getline(std::cin, line)) {
+
+        std::istringstream job(line);
+        std::string waves_file, mem_file, pass_addr, fail_addr, cov_file;
+        std::string trace_file = "-";
+        vluint64_t  max_cycles = 0;
+
+        if(!(job >> waves_file >> mem_file >> pass_addr >> fail_addr
+                 >> cov_file)) {
+            std::cout << "Bad job: '" << line << "'" << std::endl;
+            std::cout << "JOB END" << std::endl;
+            continue;
+        }
+
+        job >> max_cycles >> trace_file;
+
+        std::cout << "Starting Verilator Simulation..." << std::endl;
+
+        sim -> reset();
+        
+        if(max_cycles) {
+            sim -> set_max_cycles(max_cycles);
+        }
+
+        setup_test(sim, waves_file.c_str(), mem_file.c_str(),
+                   pass_addr.c_str(), fail_addr.c_str(), cov_file.c_str(),
+                   trace_file.c_str());
+
+        report_result(sim -> run_sim());
+
+        std::cout << "JOB END" << std::endl;
+    }
+}
+
 int main(int argc, char **argv, char **env) {
 
-    if(argc != 6) {
+    // Positional arguments. Anything starting with '+' is a plusarg.
+    std::vector<char*> args;
+    for(int i = 1; i < argc; i ++) {
+        if(argv[i][0] != '+') {
+            args.push_back(argv[i]);
+        }
+    }
+
+    Verilated::commandArgs(argc, argv);
+
+    bool batch = plusarg_value("BATCH") != nullptr;
+
+    if(args.size() != 5 && !(batch && args.size() == 0)) {
         std::cout 
             << "Usage: " << argv[0] 
-            << " <waves file> <memory file> <pass addr> <fail addr> <cov file>"
+            << " <waves file|-> <memory file> <pass addr> <fail addr> <cov file>"
+            << " [+MAX_CYCLES=<n>] [+RETIRE_TRACE=<file>]" << std::endl
+            << "       " << argv[0] << " +BATCH" << std::endl
+            << "Wave options: [+WAVE_START=<cycle>] [+WAVE_END=<cycle>]"
+            << " [+WAVE_TRIGGER_ADDR=<hex>] [+WAVE_RING=<cycles>]"
             << std::endl;
         exit(1);
     }
 
-    std::cout << "Starting Verilator Simulation..." << std::endl;
+    verilator_sim   * sim = new verilator_sim;
 
-    Verilated::commandArgs(argc, argv);
+    setup_waves(sim);
 
-    verilator_sim   * sim = new verilator_sim;
+    if(batch) {
+        run_batch(sim);
+        delete sim;
+        exit(0);
+    }
 
-    char            * waves_file = argv[1];
-    char            * mem_file   = argv[2];
-    vluint32_t        pass_addr  = std::stoul(argv[3],nullptr,16);
-    vluint32_t        fail_addr  = std::stoul(argv[4],nullptr,16);
-    char            * cov_file   = argv[5];
+    std::cout << "Starting Verilator Simulation..." << std::endl;
 
-    std::cout << "Pass address: " << pass_addr << " " << argv[3] << std::endl;
-    std::cout << "Fail address: " << fail_addr << " " << argv[4] << std::endl;
+    const char      * max_cycles = plusarg_value("MAX_CYCLES=");
 
-    sim -> dump_waves_to(waves_file);
-    sim -> dump_coverage_to(cov_file);
-    sim -> set_pass_fail_addrs(pass_addr, fail_addr);
-    sim -> preload_main_memory(mem_file, 0x80000000);
+    if(max_cycles) {
+        sim -> set_max_cycles(std::stoull(max_cycles));
+    }
+
+    setup_test(sim, args[0], args[1], args[2], args[3], args[4],
+               plusarg_value("RETIRE_TRACE="));
 
     bool result = sim -> run_sim();
     
     delete sim;
     
-    std::cout << "Finished with code " << result << std::endl;
-    
-    if(result) {
-        std::cout << "TEST PASS" << std::endl;
-        exit(0);
-    } else {
-        std::cout << "TEST FAIL" << std::endl;
-        exit(1);
-    }
+    report_result(result);
+
+    exit(result ? 0 : 1);
 }
@@ -1,7 +1,16 @@
 
+#include <cstdio>
+#include <cstring>
 #include <fstream>
 #include <iostream>
 #include <string>
+#include <vector>
+
+#include <elf.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
 
 #include "verilator_sim.hpp"
 
@@ -38,45 +47,252 @@ void verilator_sim::dump_waves_to(const char * filepath){
 void verilator_sim::dump_coverage_to(const char * filepath){
     this -> cov_data_file = filepath;
 }
+
+
+/*!
+@brief Write a record of every instruction the DUT retires to the
+       supplied file path.
+@param in filepath - The file to write the retire trace to.
+*/
+void verilator_sim::trace_retire_to(const char * filepath){
+    this -> retire_trace_file = filepath;
+}
+
+
+/*!
+@brief Open the retire trace file and write its header.
+*/
+void verilator_sim::open_retire_trace(){
+    
+    this -> retire_trace = fopen(this -> retire_trace_file, "wb");
+
+    if(this -> retire_trace == nullptr) {
+        std::cerr << "ERROR: Could not open file for writing: "
+                  << this -> retire_trace_file << std::endl;
+        return;
+    }
+
+    vluint32_t header[2] = {RETIRE_TRACE_VERSION, sizeof(retire_record)};
+    fwrite(RETIRE_TRACE_MAGIC, 1, 8, this -> retire_trace);
+    fwrite(header, sizeof(header), 1, this -> retire_trace);
+
+    this -> retire_buffer.clear();
+    this -> retire_buffer.reserve(retire_buffer_size);
+
+    std::cout << "Retire trace will be written to: "
+              << this -> retire_trace_file << std::endl;
+}
+
+
+/*!
+@brief Buffer a record if the DUT retired an instruction.
+@details Called on every *rising* edge of the system clock.
+*/
+void verilator_sim::record_retire(){
+
+    if(this -> retire_trace == nullptr || !dut -> trs_valid) {
+        return;
+    }
+
+    retire_record record;
+    record.cycle    = sim_time / clk_period;
+    record.pc       = dut -> trs_pc;
+    record.instr    = dut -> trs_instr;
+    record.rd_wdata = dut -> trs_rd_wdata;
+    record.rd_info  = (dut -> trs_rd_addr & 0x1F) |
+                      (dut -> trs_rd_wen ? 0x100 : 0);
+
+    this -> retire_buffer.push_back(record);
+
+    if(this -> retire_buffer.size() >= retire_buffer_size) {
+        fwrite(this -> retire_buffer.data(), sizeof(retire_record),
+               this -> retire_buffer.size(), this -> retire_trace);
+        this -> retire_buffer.clear();
+    }
+}
+
+
+/*!
+@brief Write out any buffered records and close the retire trace.
+*/
+void verilator_sim::close_retire_trace(){
+
+    if(this -> retire_trace == nullptr) {
+        return;
+    }
+
+    fwrite(this -> retire_buffer.data(), sizeof(retire_record),
+           this -> retire_buffer.size(), this -> retire_trace);
+    this -> retire_buffer.clear();
+
+    fclose(this -> retire_trace);
+    this -> retire_trace = nullptr;
+}
         
         
 /*!
-@brief Load a hex file into main memory at the supplied offset.
+@brief Load a memory image into main memory at the supplied offset.
+@details ELF images are recognised by their magic number and raw binary
+         images by a ".bin" extension. Anything else is read as a hex file
+         with one memory word per line.
 @note This should be done before simulation is started.
 */
 void verilator_sim::preload_main_memory(const char *filepath, 
                                         vluint32_t offset){
     std::cout << "Loading main memory with '"<<filepath<<"' at offset "
               << offset << std::endl;
+
+    std::string path(filepath);
+    bool        is_bin = path.size() >= 4 &&
+                         path.compare(path.size() - 4, 4, ".bin") == 0;
+
+    // Map the whole file into our address space, rather than reading it.
+    int fd = open(filepath, O_RDONLY);
+    struct stat st;
+
+    if(fd < 0 || fstat(fd, &st) != 0) {
+        std::cerr << "ERROR: Could not open file for reading: "
+                  << filepath << std::endl;
+        if(fd >= 0) {close(fd);}
+        return;
+    }
+
+    size_t          size = st.st_size;
+    unsigned char * data = nullptr;
+
+    if(size > 0) {
+        void * mapped = mmap(nullptr, size, PROT_READ, MAP_PRIVATE, fd, 0);
+        data = mapped == MAP_FAILED ? nullptr : (unsigned char*)mapped;
+    }
+    close(fd);
+
+    if(size > 0 && data == nullptr) {
+        std::cerr << "ERROR: Could not map file: " << filepath << std::endl;
+        return;
+    }
+
+    if(size >= SELFMAG && memcmp(data, ELFMAG, SELFMAG) == 0) {
+        preload_elf(data, size, offset);
+    } else if(is_bin) {
+        size_t loaded = preload_bytes(offset, data, size);
+        std::cout << "Loaded from " << offset << " to " 
+                  << offset + loaded << std::endl;
+    } else {
+        preload_hex(data, size, offset);
+    }
+
+    if(data != nullptr) {
+        munmap(data, size);
+    }
+}
+
+
+/*!
+@brief Load a hex file, one memory word per line, at the supplied offset.
+*/
+void verilator_sim::preload_hex(const unsigned char * data, size_t size,
+                                vluint32_t offset){
+    const char            * pos = (const char*)data;
+    const char            * end = pos + size;
+    std::vector<vluint32_t> words;
     
-    // Open the file for reading.
-    std::ifstream hexfile;
-    hexfile.open(filepath);
+    // Read the file line by line, each line is a memory word.
+    while(pos < end) {
+        const char * eol = (const char*)memchr(pos, '\n', end - pos);
+        if(eol == nullptr) {eol = end;}
+        std::string line(pos, eol);
+        if(line.find_first_not_of(" \t\r") != std::string::npos) {
+            words.push_back(std::stoul(line,nullptr,16));
+        }
+        pos = eol + 1;
+    }
 
-    if(hexfile.is_open()) {
+    // Then copy it into memory in one go.
+    size_t      loaded  = main_memory -> preload(offset, words.data(),
+                                                 words.size());
+    vluint32_t  pointer = offset + loaded * 4;
+
+    std::cout << "Loaded from " << offset << " to " 
+              << pointer << std::endl;
+}
 
-        std::string line;
-        vluint32_t  pointer = offset;
-        
-        // Read the file line by line, each line is a memory word.
-        while(getline(hexfile, line)) {
-            vluint32_t data = std::stoul(line,nullptr,16);
-            
-            main_memory -> store(pointer, data);
 
-            pointer += 4;
+/*!
+@brief Load the PT_LOAD segments of a 32-bit little endian ELF image.
+@details Segments are placed at their physical address. Segments whose
+         address is below the offset, such as those moved by the
+         "--change-addresses" step of prep-tests.sh, are placed relative
+         to the offset instead, just as elf2hex output would be.
+*/
+void verilator_sim::preload_elf(const unsigned char * data, size_t size,
+                                vluint32_t offset){
+    const Elf32_Ehdr * ehdr = (const Elf32_Ehdr*)data;
+
+    if(size < sizeof(Elf32_Ehdr) ||
+       ehdr -> e_ident[EI_CLASS] != ELFCLASS32 ||
+       ehdr -> e_ident[EI_DATA]  != ELFDATA2LSB) {
+        std::cerr << "ERROR: Only 32-bit little endian ELF files are "
+                  << "supported." << std::endl;
+        return;
+    }
+
+    for(int i = 0; i < ehdr -> e_phnum; i ++) {
+        size_t phoff = ehdr -> e_phoff + (size_t)i * ehdr -> e_phentsize;
+        if(phoff + sizeof(Elf32_Phdr) > size) {
+            break;
         }
 
-        hexfile.close();
+        const Elf32_Phdr * phdr = (const Elf32_Phdr*)(data + phoff);
+
+        if(phdr -> p_type != PT_LOAD || phdr -> p_filesz == 0 ||
+           phdr -> p_offset + phdr -> p_filesz > size) {
+            continue;
+        }
+
+        vluint32_t address = phdr -> p_paddr;
+        if(address < offset) {
+            address += offset;
+        }
+
+        size_t loaded = preload_bytes(address, data + phdr -> p_offset,
+                                      phdr -> p_filesz);
+
+        std::cout << "Loaded from " << address << " to " 
+                  << address + loaded << std::endl;
+    }
+}
 
-        std::cout << "Loaded from " << offset << " to " 
-                  << pointer << std::endl;
 
+/*!
+@brief Copy bytes into main memory starting at a word aligned address.
+@details Assumes a little endian host, so the bytes can be copied as
+         words. A partial final word is written with a byte strobe.
+@returns The number of bytes loaded.
+*/
+size_t verilator_sim::preload_bytes(vluint32_t address,
+                                    const unsigned char * bytes,
+                                    size_t count){
+    size_t words  = count / 4;
+    size_t loaded = 0;
+
+    if((uintptr_t)bytes % alignof(vluint32_t) == 0) {
+        loaded = main_memory -> preload(address,
+                                        (const vluint32_t*)bytes, words);
     } else {
-        std::cerr << "ERROR: Could not open file for reading: "
-                  << filepath << std::endl;
+        std::vector<vluint32_t> aligned(words);
+        memcpy(aligned.data(), bytes, words * 4);
+        loaded = main_memory -> preload(address, aligned.data(), words);
     }
-    
+
+    size_t tail = count % 4;
+    if(loaded == words && tail > 0) {
+        vluint32_t last = 0;
+        memcpy(&last, bytes + words * 4, tail);
+        main_memory -> store(address + words * 4, last, (1 << tail) - 1);
+        return count;
+    }
+
+    return loaded * 4;
 }
        
 
@@ -91,35 +307,180 @@ void verilator_sim::set_pass_fail_addrs(vluint32_t pass, vluint32_t fail)
 }
 
         
+/*!
+@brief Set the maximum number of clock cycles to simulate before the
+       simulation times out.
+*/
+void verilator_sim::set_max_cycles(vluint64_t cycles)
+{
+    this -> max_sim_time = cycles * this -> clk_period;
+}
+
+        
+/*!
+@brief Only dump waves from clock cycle start up to, but not including,
+       clock cycle end. An end of zero means no end.
+*/
+void verilator_sim::set_wave_window(vluint64_t start, vluint64_t end)
+{
+    this -> wave_start_cycle = start;
+    this -> wave_end_cycle   = end;
+}
+
+/*!
+@brief Only start dumping waves once this address is seen on the AXI read
+       or write address channel.
+*/
+void verilator_sim::set_wave_trigger(vluint32_t address)
+{
+    this -> wave_trigger_enabled = true;
+    this -> wave_trigger_address = address;
+}
+
+/*!
+@brief Keep waves in two rotating segments of "cycles" clock cycles each.
+*/
+void verilator_sim::set_wave_ring(vluint64_t cycles)
+{
+    this -> wave_ring_cycles = cycles;
+}
+
+/*!
+@brief Dump the current state of the DUT to the waves file, if waves are
+       being dumped at this time. Starts a new wave segment when the ring
+       buffer is on and the current segment is full.
+*/
+void verilator_sim::update_wave_dump()
+{
+    if(!this -> wave_tracing || !this -> wave_triggered) {
+        return;
+    }
+
+    vluint64_t cycle = sim_time / clk_period;
+
+    if(cycle < this -> wave_start_cycle ||
+       (this -> wave_end_cycle && cycle >= this -> wave_end_cycle)) {
+        return;
+    }
+
+    if(this -> wave_ring_cycles) {
+        if(!this -> wave_segment_used) {
+            this -> wave_segment_start = cycle;
+            this -> wave_segment_used  = true;
+        } else if(cycle - this -> wave_segment_start >=
+                  this -> wave_ring_cycles) {
+            // Re-opening the tracer writes the VCD header again, and its
+            // next dump is of every signal, so each segment can be viewed
+            // on its own.
+            std::string prev = std::string(this -> wave_trace_file) + ".prev";
+            this -> wave_dump -> close();
+            std::rename(this -> wave_trace_file, prev.c_str());
+            this -> wave_dump -> open(this -> wave_trace_file);
+            this -> wave_segment_start = cycle;
+        }
+    }
+
+    this -> wave_dump -> dump(this -> sim_time);
+}
+
+/*!
+@brief Check if the DUT has put the wave trigger address on the AXI bus.
+*/
+void verilator_sim::check_wave_trigger()
+{
+    if(this -> wave_triggered) {
+        return;
+    }
+
+    if((dut -> M_AXI_ARVALID &&
+        dut -> M_AXI_ARADDR == this -> wave_trigger_address) ||
+       (dut -> M_AXI_AWVALID &&
+        dut -> M_AXI_AWADDR == this -> wave_trigger_address)) {
+
+        std::cout << "Wave trigger address seen at cycle "
+                  << sim_time / clk_period << std::endl;
+        this -> wave_triggered = true;
+    }
+}
+
+/*!
+@brief Return the simulation time of the next clock edge or reset
+       change after the current simulation time.
+@details The clock toggles on ticks where sim_time % (clk_period/2) == 1,
+         and reset is released on the first tick after reset_length.
+*/
+vluint64_t verilator_sim::next_event_time()
+{
+    vluint64_t half_period = clk_period / 2;
+    vluint64_t next_edge   = sim_time - (sim_time + half_period - 1) %
+                             half_period + half_period;
+
+    if(sim_time <= reset_length && reset_length + 1 < next_edge) {
+        return reset_length + 1;
+    }
+
+    return next_edge;
+}
+
 /*!
 @brief Run the simulation to completion.
 @returns True if the sim succeded or False if it failed.
 */
 bool verilator_sim::run_sim(){
 
-    Verilated::traceEverOn(this -> wave_tracing);
-
     if(this -> wave_tracing) {
-        this -> wave_dump = new VerilatedVcdC;
-        this -> dut -> trace(this->wave_dump, 99);
+        
+        // The tracer is attached to the DUT once, then re-used for any
+        // later runs of the same DUT.
+        if(this -> wave_dump == nullptr) {
+            Verilated::traceEverOn(true);
+            this -> wave_dump = new VerilatedVcdC;
+            this -> dut -> trace(this->wave_dump, 99);
+        }
+
         this -> wave_dump -> open(this -> wave_trace_file);
 
+        if(this -> wave_ring_cycles) {
+            std::string prev = std::string(this -> wave_trace_file) + ".prev";
+            std::remove(prev.c_str());
+        }
+
         std::cout << "Waves will be dumped to: " 
                   << this->wave_trace_file 
                   << std::endl;
     }
     
+    if(this -> retire_trace_file) {
+        this -> open_retire_trace();
+    }
+    
     // Initial input signal values.
     dut -> ARESETn  = 0;
     dut -> ACLK     = 0;
     sim_time = 0;
 
+    this -> wave_triggered      = !this -> wave_trigger_enabled;
+    this -> wave_segment_start  = 0;
+    this -> wave_segment_used   = false;
+
+    // Inputs only change on clock edges and when reset is released, so
+    // the model is only evaluated at those times. Evaluating it between
+    // them would change nothing.
+    dut->eval();
+
+    this -> update_wave_dump();
+
     while (!Verilated::gotFinish()  && 
-           sim_time < max_sim_time  &&
            !this -> break_sim_loop  )
     {
+        sim_time = this -> next_event_time();
+
+        if(sim_time >= max_sim_time) {
+            sim_time = max_sim_time;
+            break;
+        }
         
-        if(sim_time > 40) {
+        if(sim_time > reset_length) {
             dut -> ARESETn = 1;
         }
         
@@ -131,6 +492,8 @@ bool verilator_sim::run_sim(){
             if(dut -> ACLK) {
                 this -> handle_dut_io();
                 this -> check_pass_fail();
+                this -> check_wave_trigger();
+                this -> record_retire();
             }
         }
 
@@ -138,25 +501,39 @@ bool verilator_sim::run_sim(){
         dut->eval();
 
         // Update the wavedump file.
-        if(this -> wave_tracing) {
-            this -> wave_dump -> dump(this -> sim_time);
-        }
-
-        // Increment simulation time.
-        sim_time ++;
+        this -> update_wave_dump();
     }
     
     // Close the wave tracer if need be.
     if(this -> wave_tracing) {
         this -> wave_dump -> close();
+
+        // A wave ring is only kept for tests which did not pass. The
+        // earlier segment, if there is one, holds the cycles before those
+        // in the waves file.
+        if(this -> wave_ring_cycles) {
+            std::string prev = std::string(this -> wave_trace_file) + ".prev";
+            if(this -> sim_passed) {
+                std::remove(this -> wave_trace_file);
+                std::remove(prev.c_str());
+            } else {
+                std::ifstream prev_fh(prev.c_str());
+                std::cout << "Wave ring segments: "
+                          << (prev_fh ? prev + " " : std::string())
+                          << this -> wave_trace_file << std::endl;
+            }
+        }
     }
 
-    dut -> final();
+    this -> close_retire_trace();
 
     if(this -> cov_data_file) {
         std::cout << "Writing Coverage Data: "<<this->cov_data_file<< std::endl;
         VerilatedCov::write(this -> cov_data_file);
     }
+
+    // Reported before the result so regression.py always sees it.
+    std::cout << "Simulated cycles: " << sim_time / clk_period << std::endl;
     
     if(sim_time >= max_sim_time){
         std::cerr << "TIMEOUT" << std::endl;
@@ -197,18 +574,9 @@ void verilator_sim::handle_dut_io() {
     if(dut -> M_AXI_AWVALID && dut -> M_AXI_WVALID) {
         
         vluint32_t address = dut -> M_AXI_AWADDR & 0xFFFFFFFC;
-        
-        vluint32_t mask    = ((dut -> M_AXI_WSTRB & 0x8 ? 0xFF : 0x00) << 24) |
-                             ((dut -> M_AXI_WSTRB & 0x4 ? 0xFF : 0x00) << 16) |
-                             ((dut -> M_AXI_WSTRB & 0x2 ? 0xFF : 0x00) <<  8) |
-                             ((dut -> M_AXI_WSTRB & 0x1 ? 0xFF : 0x00) <<  0) ;
-        
-        vluint32_t new_data= dut -> M_AXI_WDATA;
-        vluint32_t old_data= main_memory -> load(address);
 
-        vluint32_t store   = (new_data & mask) | (old_data & ~mask);
-
-        main_memory -> store ( address, store);
+        main_memory -> store ( address, dut -> M_AXI_WDATA, 
+                                        dut -> M_AXI_WSTRB);
         
         dut -> M_AXI_AWREADY    = 1;
         dut -> M_AXI_WREADY     = 1;
@@ -243,11 +611,55 @@ void verilator_sim::check_pass_fail() {
 
 
 
+/*!
+@brief Reset the simulation so that another test can be run on the same
+       DUT instance.
+@details Main memory is cleared, coverage counts are zeroed, the AXI
+    inputs to the DUT are driven low, any $finish seen by the last test is
+    forgotten and all test settings return to their defaults.
+    The DUT itself is put back into reset at the start of the next call to
+    run_sim. Every register in the RTL has an asynchronous reset, so this
+    returns it to its post reset state. Any state added to the RTL without
+    a reset, such as an initial block or a memory array, would carry over
+    from one test to the next.
+*/
+void verilator_sim::reset() {
+
+    this -> main_memory -> clear();
+
+    dut -> M_AXI_ARREADY = 0;
+    dut -> M_AXI_AWREADY = 0;
+    dut -> M_AXI_WREADY  = 0;
+    dut -> M_AXI_RVALID  = 0;
+    dut -> M_AXI_BVALID  = 0;
+    dut -> M_AXI_RDATA   = 0;
+    dut -> M_AXI_RRESP   = 0;
+    dut -> M_AXI_BRESP   = 0;
+
+    Verilated::gotFinish(false);
+
+    this -> break_sim_loop  = false;
+    this -> sim_passed      = false;
+    this -> pass_address    = 0xFFFFFFFF;
+    this -> fail_address    = 0xFFFFFFFF;
+    this -> max_sim_time    = default_max_sim_time;
+    this -> wave_tracing    = false;
+    this -> wave_trace_file = nullptr;
+    this -> cov_data_file   = nullptr;
+    this -> retire_trace_file = nullptr;
+
+    VerilatedCov::zero();
+}
+
+
 /*!
 @brief Clean up a completed simulation of the DUT
 */
 verilator_sim::~verilator_sim() {
     
+    dut -> final();
+
     delete this -> dut;
     delete this -> main_memory;
+    delete this -> wave_dump;
 }
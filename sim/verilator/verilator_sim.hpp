@@ -11,6 +11,29 @@
 #ifndef H_VERILATOR_SIM
 #define H_VERILATOR_SIM
 
+#include <cstdio>
+#include <vector>
+
+/*!
+@brief One record of a retire trace file, written in host (little endian)
+       byte order. The file starts with an 8 byte RETIRE_TRACE_MAGIC, then a
+       32-bit format version and the 32-bit size of each record. See
+       bin/pytrace.py for a reader.
+*/
+struct retire_record {
+    vluint64_t  cycle;      //!< Clock cycle the retirement was seen on.
+    vluint32_t  pc;         //!< Address of the instruction.
+    vluint32_t  instr;      //!< Encoding of the instruction.
+    vluint32_t  rd_wdata;   //!< Value written to rd, if any.
+    vluint32_t  rd_info;    //!< rd address in bits 4:0, write enable bit 8.
+};
+
+//! First bytes of every retire trace file.
+#define RETIRE_TRACE_MAGIC      "RVMTRACE"
+
+//! Version of the retire trace file format.
+#define RETIRE_TRACE_VERSION    1
+
 
 /*
 @brief Contains everything needed to run a simple verilator simulation.
@@ -34,9 +57,17 @@ class verilator_sim {
         @param in filepath - The file to write coverage data to.
         */
         void dump_coverage_to(const char * filepath);
+        
+        /*!
+        @brief Write a record of every instruction the DUT retires to the
+               supplied file path.
+        @param in filepath - The file to write the retire trace to.
+        */
+        void trace_retire_to(const char * filepath);
 
         /*!
-        @brief Load a hex file into main memory at the supplied offset.
+        @brief Load a hex, raw binary (.bin) or ELF file into main memory
+               at the supplied offset.
         @note This should be done before simulation is started.
         */
         void preload_main_memory(const char *filepath, vluint32_t offset);
@@ -47,11 +78,54 @@ class verilator_sim {
         */
         void set_pass_fail_addrs(vluint32_t pass, vluint32_t fail);
         
+        /*!
+        @brief Set the maximum number of clock cycles to simulate before the
+               simulation times out.
+        */
+        void set_max_cycles(vluint64_t cycles);
+        
+        /*!
+        @brief Only dump waves from clock cycle start up to, but not
+               including, clock cycle end. An end of zero means no end.
+        */
+        void set_wave_window(vluint64_t start, vluint64_t end);
+        
+        /*!
+        @brief Only start dumping waves once the DUT puts this address on
+               the AXI read or write address channel. Instruction fetches
+               use the read channel, so this can be used to trigger on a
+               program counter value.
+        */
+        void set_wave_trigger(vluint32_t address);
+        
+        /*!
+        @brief Keep waves in two rotating segments of "cycles" clock
+               cycles each, rather than for the whole run.
+        @details When the segment in the waves file is full, it is moved to
+                 "<file>.prev" and a new segment is started in the waves
+                 file. Between them the two files hold the last "cycles" to
+                 2 * "cycles" clock cycles. Each segment is started by
+                 closing and re-opening the same tracer, which writes the
+                 VCD header again and a full dump of every signal first,
+                 so each file can be viewed on its own. Both are deleted
+                 if the test passes, and both paths are printed if it does
+                 not.
+        */
+        void set_wave_ring(vluint64_t cycles);
+
         /*!
         @brief Run the simulation to completion.
         @returns True if the sim succeded or False if it failed.
         */
         bool run_sim();
+        
+        /*!
+        @brief Reset the simulation so that another test can be run on the
+               same DUT instance.
+        @details Only state with a reset path in the RTL is returned to its
+                 initial value. See verilator_sim.cpp.
+        */
+        void reset();
 
     private:
         
@@ -76,11 +150,35 @@ class verilator_sim {
         //! How many simulation ticks have we performed.
         vluint64_t      sim_time;
         
+        //! Default maximum number of simulation ticks before we quit.
+        static const vluint64_t default_max_sim_time = 100000;
+
         //! Maximum number of simulation ticks before we quit.
-        vluint64_t      max_sim_time = 100000;
+        vluint64_t      max_sim_time = default_max_sim_time;
 
         //! Period of the system clock in simulation ticks.
         vluint64_t      clk_period  = 20;
+
+        //! Reset is held low until after this many simulation ticks.
+        vluint64_t      reset_length = 40;
+
+        /*!
+        @brief Return the simulation time of the next clock edge or reset
+               change after the current simulation time.
+        */
+        vluint64_t      next_event_time();
+
+        //! Load a hex file image, one word per line, at offset.
+        void preload_hex(const unsigned char * data, size_t size,
+                         vluint32_t offset);
+
+        //! Load the loadable segments of an ELF image.
+        void preload_elf(const unsigned char * data, size_t size,
+                         vluint32_t offset);
+
+        //! Copy raw little endian bytes into main memory at address.
+        size_t preload_bytes(vluint32_t address, const unsigned char * bytes,
+                             size_t count);
     
         //! Should wave tracing be turned on for the simulation?
         bool            wave_tracing = false;
@@ -91,8 +189,73 @@ class verilator_sim {
         //! Where we write coverage database information to.
         const char *    cov_data_file = nullptr;
 
+        //! Where we write the retire trace to, if anywhere.
+        const char *    retire_trace_file = nullptr;
+
+        //! The open retire trace file.
+        FILE *          retire_trace = nullptr;
+
+        //! Retire records not yet written to the retire trace file.
+        std::vector<retire_record> retire_buffer;
+
+        //! Number of records buffered before they are written out.
+        static const size_t retire_buffer_size = 4096;
+
+        /*!
+        @brief Open the retire trace file and write its header.
+        */
+        void            open_retire_trace();
+
+        /*!
+        @brief Buffer a record if the DUT retired an instruction.
+        @details Called on every *rising* edge of the system clock.
+        */
+        void            record_retire();
+
+        /*!
+        @brief Write out any buffered records and close the retire trace.
+        */
+        void            close_retire_trace();
+
         //! Verilator wave tracer instance
-        VerilatedVcdC * wave_dump;
+        VerilatedVcdC * wave_dump = nullptr;
+
+        //! First clock cycle to dump waves for.
+        vluint64_t      wave_start_cycle = 0;
+
+        //! Stop dumping waves at this clock cycle. Zero means never.
+        vluint64_t      wave_end_cycle = 0;
+
+        //! Is dumping waves held off until wave_trigger_address is seen?
+        bool            wave_trigger_enabled = false;
+
+        //! Start dumping waves when this address is seen.
+        vluint32_t      wave_trigger_address = 0;
+
+        //! Has the wave trigger been seen yet in this run?
+        bool            wave_triggered = true;
+
+        //! Length of each wave segment in clock cycles. Zero for no ring.
+        vluint64_t      wave_ring_cycles = 0;
+
+        //! Clock cycle at which the current wave segment started.
+        vluint64_t      wave_segment_start = 0;
+
+        //! Has anything been dumped to the current wave segment?
+        bool            wave_segment_used = false;
+
+        /*!
+        @brief Dump the current state of the DUT to the waves file, if
+               waves are being dumped at this time.
+        */
+        void            update_wave_dump();
+
+        /*!
+        @brief Check if the DUT has put the wave trigger address on the
+               AXI bus.
+        @details Called on every *rising* edge of the system clock.
+        */
+        void            check_wave_trigger();
 
         /*!
         @brief Responsible for handling all DUT input / output pins.